@@ -0,0 +1,185 @@
+from __future__ import division
+import time
+from hopper import Hopper
+from hopperParameters import HopperParameters, boxMomentOfInertia
+from hopperUtil import *
+from persistentSolver import PersistentSolver
+
+legLength = 0.16
+hipInBody = {'front': {'x': 0.5*legLength, 'z': -0.25*legLength},
+             'back': {'x': -0.5*legLength, 'z': -0.25*legLength}}
+parameters = HopperParameters(legLength, hipInBody, boxMomentOfInertia(legLength, hipInBody))
+
+def constructBenchmarkHopper(N, reformulation='hull'):
+    hop = Hopper(N, parameters=parameters, reformulation=reformulation)
+    addThreePlatfomWorld(hop, legLength, 0.3*legLength)
+    return hop
+
+def timeModelAssembly(N, assemblies=('rules', 'arrays')):
+    hop = constructBenchmarkHopper(N)
+    times = {}
+    for assembly in assemblies:
+        t0 = time.time()
+        hop.constructPyomoModel(assembly=assembly)
+        times[assembly] = time.time() - t0
+    return times
+
+def timeReformulation(N, reformulation, opt=None):
+    hop = constructBenchmarkHopper(N, reformulation)
+    t0 = time.time()
+    m = hop.constructPyomoModel(assembly='arrays')
+    buildTime = time.time() - t0
+    nVariables, nConstraints = modelSize(m)
+    solveTime = None
+    if opt is not None:
+        m = constructRelaxedModel(m)
+        addHopperObjective(m, hop)
+        addBoundaryConditions(m, [0, legLength/2], [1.0, legLength], legLength)
+        t0 = time.time()
+        opt.solve(m)
+        solveTime = time.time() - t0
+    return nVariables, nConstraints, buildTime, solveTime
+
+def timePartitionedRelaxation(N, partitions, encoding, opt=None):
+    hop = constructBenchmarkHopper(N)
+    m_nlp = hop.constructPyomoModel(assembly='arrays')
+    t0 = time.time()
+    m = constructRelaxedModel(m_nlp, partitions=partitions, encoding=encoding, discretize=[m_nlp.f])
+    relaxTime = time.time() - t0
+    nVariables, nConstraints = modelSize(m)
+    solveTime = residual = None
+    if opt is not None:
+        addHopperObjective(m, hop)
+        addBoundaryConditions(m, [0, legLength/2], [1.0, legLength], legLength)
+        t0 = time.time()
+        results = solveModel(m, opt)
+        solveTime = time.time() - t0
+        if len(results.solution) > 0:
+            residual = bilinearResidual(m)
+    return nVariables, nConstraints, relaxTime, solveTime, residual
+
+def timeRelaxation(N, relaxation, accuracy, opt=None):
+    # 'mccormick' or 'mdt' at the given accuracy of the bilinear terms
+    hop = constructBenchmarkHopper(N)
+    m_nlp = hop.constructPyomoModel(assembly='arrays')
+    t0 = time.time()
+    if relaxation == 'mdt':
+        m = constructMDTModel(m_nlp, accuracy)
+    else:
+        m = constructRelaxedModel(m_nlp)
+    relaxTime = time.time() - t0
+    nVariables, nConstraints = modelSize(m)
+    solveTime = residual = None
+    if opt is not None:
+        addHopperObjective(m, hop)
+        addBoundaryConditions(m, [0, legLength/2], [1.0, legLength], legLength)
+        t0 = time.time()
+        results = solveModel(m, opt)
+        solveTime = time.time() - t0
+        if len(results.solution) > 0:
+            residual = torqueBalanceResidual(m)
+    return nVariables, nConstraints, relaxTime, solveTime, residual
+
+def timeResolves(N, opt, persistent, nSolves=5, norm=normL2):
+    # Re-solves from shifted initial positions, with the model rebuilt by
+    # the solver interface every time or kept by a PersistentSolver.
+    hop = constructBenchmarkHopper(N)
+    m = constructRelaxedModel(hop.constructPyomoModel(assembly='arrays', prune=False))
+    addHopperObjective(m, hop, norm=norm)
+    addMutableBoundaryConditions(m)
+    m.finalPositionMin = 1.0/legLength
+    solver = PersistentSolver(m, opt) if persistent else None
+    times = []
+    for i in range(nSolves):
+        m.initialPosition['x'] = 0.02*i/legLength
+        t0 = time.time()
+        if solver is not None:
+            solver.solve()
+        else:
+            opt.solve(m)
+        times.append(time.time() - t0)
+    return times
+
+def timeOrientationEncoding(N, sectors, encoding, opt=None):
+    # Piecewise-linear cos/sin of the orientation with the given number of
+    # sectors, 'cc' or 'log' segment selection
+    hop = constructBenchmarkHopper(N)
+    hop.nOrientationSectors = sectors
+    hop.orientationEncoding = encoding
+    t0 = time.time()
+    m = constructRelaxedModel(hop.constructPyomoModel(assembly='arrays'))
+    buildTime = time.time() - t0
+    nVariables, nConstraints = modelSize(m)
+    nBinaries = sum(1 for var in m.component_data_objects(Var) if not var.is_continuous() and not var.fixed)
+    solveTime = None
+    if opt is not None:
+        addHopperObjective(m, hop)
+        addBoundaryConditions(m, [0, legLength/2], [1.0, legLength], legLength)
+        t0 = time.time()
+        opt.solve(m)
+        solveTime = time.time() - t0
+    return nVariables, nConstraints, nBinaries, buildTime, solveTime
+
+if __name__ == '__main__':
+    # The assemblies give the same models and the reformulations and
+    # encodings the sizes they should, see testHopperModels.py
+    print '%5s %10s %10s %8s' % ('N', 'rules [s]', 'arrays [s]', 'speedup')
+    for N in [25, 50, 100]:
+        times = timeModelAssembly(N)
+        print '%5d %10.3f %10.3f %8.2f' % (N, times['rules'], times['arrays'], times['rules']/times['arrays'])
+
+    opt = None
+    if SolverFactory('_gurobi_direct').available(exception_flag=False):
+        opt = constructGurobiSolver(TimeLimit=480.)
+    print
+    print '%5s %8s %8s %8s %10s %10s' % ('N', 'reform', 'vars', 'cons', 'build [s]', 'solve [s]')
+    for N in [10, 25]:
+        for reformulation in ['hull', 'bigm', 'hybrid']:
+            nVariables, nConstraints, buildTime, solveTime = timeReformulation(N, reformulation, opt)
+            print '%5d %8s %8d %8d %10.3f %10s' % (N, reformulation, nVariables, nConstraints, buildTime,
+                                                    '-' if solveTime is None else '%.3f' % solveTime)
+
+    print
+    print '%5s %8s %4s %8s %8s %10s %10s %10s' % ('N', 'encoding', 'K', 'vars', 'cons', 'relax [s]', 'solve [s]', 'residual')
+    for encoding in ['linear', 'log']:
+        for partitions in [1, 2, 4, 8]:
+            nVariables, nConstraints, relaxTime, solveTime, residual = timePartitionedRelaxation(25, partitions, encoding, opt)
+            print '%5d %8s %4d %8d %8d %10.3f %10s %10s' % (25, encoding, partitions, nVariables, nConstraints, relaxTime,
+                                                            '-' if solveTime is None else '%.3f' % solveTime,
+                                                            '-' if residual is None else '%.3g' % residual)
+
+    print
+    print '%5s %10s %8s %8s %8s %10s %10s %10s' % ('N', 'relax', 'accuracy', 'vars', 'cons', 'relax [s]', 'solve [s]', 'torque err')
+    for relaxation, accuracy in [('mccormick', None), ('mdt', 0.1), ('mdt', 0.01)]:
+        nVariables, nConstraints, relaxTime, solveTime, residual = timeRelaxation(25, relaxation, accuracy, opt)
+        print '%5d %10s %8s %8d %8d %10.3f %10s %10s' % (25, relaxation, '-' if accuracy is None else '%g' % accuracy,
+                                                         nVariables, nConstraints, relaxTime,
+                                                         '-' if solveTime is None else '%.3f' % solveTime,
+                                                         '-' if residual is None else '%.3g' % residual)
+
+    resolveSolvers = []
+    if SolverFactory('_gurobi_direct').available(exception_flag=False):
+        resolveSolvers = [('gurobi', constructGurobiSolver(TimeLimit=60.), constructGurobiSolver(persistent=True, TimeLimit=60.),
+                           normL2)]
+    else:
+        # cbc and glpk only take linear objectives
+        for name in ['cbc', 'glpk']:
+            if SolverFactory(name).available(exception_flag=False):
+                resolveSolvers = [(name, SolverFactory(name), SolverFactory(name), normL1)]
+                break
+    print
+    print '%5s %8s %12s %12s %12s %12s' % ('N', 'solver', 'first [s]', 'rebuild [s]', 'first [s]', 'persist [s]')
+    for name, resolveOpt, persistentOpt, norm in resolveSolvers:
+        rebuild = timeResolves(10, resolveOpt, False, norm=norm)
+        persistent = timeResolves(10, persistentOpt, True, norm=norm)
+        print '%5d %8s %12.3f %12.3f %12.3f %12.3f' % (10, name, rebuild[0], sum(rebuild[1:])/len(rebuild[1:]),
+                                                       persistent[0], sum(persistent[1:])/len(persistent[1:]))
+
+    print
+    print '%5s %8s %8s %8s %8s %8s %10s %10s' % ('N', 'encoding', 'sectors', 'vars', 'cons', 'binaries', 'build [s]',
+                                                 'solve [s]')
+    for sectors in [1, 4, 16, 64]:
+        for encoding in ['cc', 'log']:
+            nVariables, nConstraints, nBinaries, buildTime, solveTime = timeOrientationEncoding(10, sectors, encoding, opt)
+            print '%5d %8s %8d %8d %8d %8d %10.3f %10s' % (10, encoding, sectors, nVariables, nConstraints, nBinaries,
+                                                           buildTime, '-' if solveTime is None else '%.3f' % solveTime)
@@ -0,0 +1,154 @@
+from __future__ import division
+import itertools
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+from hopper import Hopper
+from hopperParameters import HopperParameters, boxMomentOfInertia
+from hopperUtil import *
+
+legLength = 0.16
+hipInBody = {'front': {'x': 0.5*legLength, 'z': -0.25*legLength},
+             'back': {'x': -0.5*legLength, 'z': -0.25*legLength}}
+parameters = HopperParameters(legLength, hipInBody, boxMomentOfInertia(legLength, hipInBody))
+
+phases = ['hopper', 'model', 'transform', 'relax', 'objective', 'write', 'solve', 'extract']
+
+# Regressions are flagged when a phase is both this much slower relative to
+# the baseline and slower by more than minimumSlowdown seconds.
+tolerance = 0.25
+minimumSlowdown = 0.05
+
+
+def benchmarkCases(Ns=(10, 25, 50, 100), regions=(3, 10, 25, 50), reformulations=('hull', 'bigm', 'hybrid'),
+                   relaxations=('mccormick', 'mdt')):
+    for N, nRegions, reformulation, relaxation in itertools.product(Ns, regions, reformulations, relaxations):
+        yield {'N': N, 'regions': nRegions, 'reformulation': reformulation, 'relaxation': relaxation}
+
+def caseName(case):
+    return 'N%(N)d-regions%(regions)d-%(reformulation)s-%(relaxation)s' % case
+
+def openSourceSolver(timeLimit=None):
+    # The first locally installed open-source MIP solver, or None.
+    for name, timeLimitOption in [('cbc', 'sec'), ('glpk', 'tmlim')]:
+        opt = SolverFactory(name)
+        if opt is not None and opt.available(exception_flag=False):
+            if timeLimit is not None:
+                opt.options[timeLimitOption] = timeLimit
+            return opt
+    return None
+
+def runCase(case, solverTimeLimit=None, accuracy=0.1):
+    timings = dict.fromkeys(phases)
+    t0 = time.time()
+    hop = Hopper(case['N'], parameters=parameters, reformulation=case['reformulation'])
+    # A staircase with an odd number of regions starts with two platforms
+    # on the ground
+    addStaircaseWorld(hop, legLength, 0.3*legLength, (case['regions'] + 1)//2, 1 + case['regions'] % 2)
+    hop.positionMax = hop.platforms[-1][1] + 1
+    timings['hopper'] = time.time() - t0
+
+    t0 = time.time()
+    m_nlp = hop.constructPyomoModel(assembly='arrays')
+    timings['transform'] = hop.timings['transform']
+    timings['model'] = time.time() - t0 - timings['transform']
+
+    t0 = time.time()
+    if case['relaxation'] == 'mdt':
+        m = constructMDTModel(m_nlp, accuracy)
+    else:
+        m = constructRelaxedModel(m_nlp)
+    timings['relax'] = time.time() - t0
+
+    # cbc and glpk only take linear objectives
+    t0 = time.time()
+    goal = hop.platforms[min(2, len(hop.platforms) - 1)]
+    addHopperObjective(m, hop, norm=normL1)
+    addBoundaryConditions(m, [0, legLength/2], [(goal[0] + goal[1])/2*legLength, legLength], legLength)
+    timings['objective'] = time.time() - t0
+
+    t0 = time.time()
+    filename = os.path.join(tempfile.gettempdir(), 'benchmarkPipeline-%d.lp' % os.getpid())
+    m.write(filename)
+    os.remove(filename)
+    timings['write'] = time.time() - t0
+
+    result = dict(case, status=None)
+    opt = openSourceSolver(solverTimeLimit)
+    if opt is not None:
+        # A failing solve or extract is recorded and leaves the timings of
+        # the other phases intact.
+        try:
+            t0 = time.time()
+            results = opt.solve(m, load_solutions=False)
+            timings['solve'] = time.time() - t0
+            result['status'] = str(results.solver.termination_condition)
+
+            t0 = time.time()
+            if len(results.solution) > 0:
+                m.solutions.load_from(results)
+                hop.loadResults(m)
+            timings['extract'] = time.time() - t0
+        except Exception as e:
+            result['status'] = 'error'
+            result['error'] = ('%s: %s' % (type(e).__name__, e)).splitlines()[0]
+
+    result['variables'], result['constraints'] = modelSize(m)
+    result['timings'] = timings
+    # kilobytes on Linux
+    result['peakRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def _runCaseWorker(args):
+    return runCase(*args)
+
+def runBenchmarks(cases, solverTimeLimit=60.):
+    # Each case runs in a fresh process so that its peak RSS is its own.
+    pool = Pool(1, maxtasksperchild=1)
+    try:
+        results = []
+        for result in pool.imap(_runCaseWorker, [(case, solverTimeLimit) for case in cases]):
+            print '%-32s %s' % (caseName(result), ' '.join('%s=%.3f' % (phase, result['timings'][phase])
+                                                             for phase in phases if result['timings'][phase] is not None))
+            results.append(result)
+    finally:
+        pool.terminate()
+    return results
+
+def compareToBaseline(results, baseline):
+    # (case, phase, baseline time, time) of every phase that got slower
+    baselineTimings = dict((caseName(result), result['timings']) for result in baseline)
+    regressions = []
+    for result in results:
+        reference = baselineTimings.get(caseName(result))
+        if reference is None:
+            continue
+        for phase in phases:
+            old, new = reference.get(phase), result['timings'][phase]
+            if old is None or new is None:
+                continue
+            if new > (1 + tolerance)*old and new - old > minimumSlowdown:
+                regressions.append((caseName(result), phase, old, new))
+    return regressions
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'benchmarkResults.json'
+    baselineFilename = sys.argv[2] if len(sys.argv) > 2 else None
+    if openSourceSolver() is None:
+        print 'No cbc or glpk found, skipping the solve and extract phases'
+    results = runBenchmarks(benchmarkCases())
+    with open(filename, 'w') as f:
+        json.dump({'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=1, sort_keys=True)
+    if baselineFilename is not None:
+        with open(baselineFilename) as f:
+            regressions = compareToBaseline(results, json.load(f)['results'])
+        for name, phase, old, new in regressions:
+            print 'REGRESSION %s %s: %.3f s -> %.3f s' % (name, phase, old, new)
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,101 @@
+from __future__ import division
+import itertools
+import numpy as np
+from collections import OrderedDict
+from pyomo.environ import *
+
+
+def _absBounds(variables):
+    # Largest |value| each variable can take
+    return np.array([max(abs(var.lb), abs(var.ub)) for var in variables])
+
+
+class CostTerms:
+    """
+    Weighted sum of cost terms for the objective of a hopper model. Each
+    norm or penalty adds at most one indexed slack Var and two indexed
+    Constraints to m, named after the term, instead of components per
+    element. Terms are kept in the order they were added and can be
+    inspected (and re-weighted) before addObjective.
+    """
+
+    def __init__(self, m):
+        self.m = m
+        self.terms = OrderedDict()
+
+    def add(self, name, expr, weight=1.):
+        self.terms[name] = [weight, expr]
+        return expr
+
+    def _addSlack(self, name, index, bodies, slackMax, scalar=False):
+        # Slack s (indexed like the bodies, or one scalar s when scalar) with
+        # -s <= body <= s
+        m = self.m
+        if scalar:
+            slack = Var(bounds=(0., float(np.max(slackMax))))
+            setattr(m, name + 'Slack', slack)
+            slacks = itertools.repeat(slack)
+        else:
+            slack = Var(index, bounds=(0., None))
+            setattr(m, name + 'Slack', slack)
+            for i, ub in itertools.izip(index, np.ravel(slackMax)):
+                slack[i].setub(float(ub))
+            slacks = (slack[i] for i in index)
+        lower = Constraint(index)
+        upper = Constraint(index)
+        setattr(m, name + 'LB', lower)
+        setattr(m, name + 'UB', upper)
+        for i, body, s in itertools.izip(index, bodies, slacks):
+            lower.add(i, (None, -body - s, 0.))
+            upper.add(i, (None, body - s, 0.))
+        return slack
+
+    def l2(self, var, weight=1., name=None):
+        return self.add(name or var.cname() + 'L2', sum(var[i]**2 for i in var.index_set()), weight)
+
+    def l1(self, var, weight=1., name=None):
+        name = name or var.cname() + 'L1'
+        index = var.index_set()
+        variables = [var[i] for i in index]
+        slack = self._addSlack(name, index, variables, _absBounds(variables))
+        return self.add(name, summation(slack), weight)
+
+    def lInfinity(self, var, weight=1., name=None):
+        name = name or var.cname() + 'LInfinity'
+        index = var.index_set()
+        variables = [var[i] for i in index]
+        slack = self._addSlack(name, index, variables, _absBounds(variables), scalar=True)
+        return self.add(name, slack, weight)
+
+    def norm(self, norm, var, weight=1.):
+        # norm is 'l1', 'l2' or 'lInfinity'
+        return getattr(self, norm)(var, weight)
+
+    def regionChanges(self, hop, weight=1., name='footRegionChange'):
+        # Number of switches into or out of each region with friction
+        # (contact region), summed over feet and time steps.
+        m = self.m
+        regions = [region for region in m.REGION_INDEX if hop.regions[region]['mu'] != 0.]
+        feet = list(m.feet)
+        t = list(m.t)
+        indicators = np.empty((len(regions), len(feet), len(t)), dtype=object)
+        for (i, region), (j, foot), (k, ti) in itertools.product(enumerate(regions), enumerate(feet), enumerate(t)):
+            indicators[i, j, k] = m.footRegionIndicators[region, foot, ti]
+        fixed = np.vectorize(lambda var: var.fixed, otypes=[bool])(indicators)
+        changes = indicators[:, :, 1:] - indicators[:, :, :-1]
+        # Changes between fixed indicators are constants
+        bothFixed = fixed[:, :, 1:] & fixed[:, :, :-1]
+        constant = sum(abs(value(change)) for change in changes[bothFixed])
+        free = np.argwhere(~bothFixed)
+        index = [(regions[i], feet[j], t[k]) for i, j, k in free]
+        setattr(m, name + 'Index', Set(initialize=index, dimen=3, ordered=True))
+        slack = self._addSlack(name, getattr(m, name + 'Index'), changes[~bothFixed], np.ones(len(index)))
+        return self.add(name, constant + summation(slack), weight)
+
+    def expression(self):
+        return sum(weight*expr for weight, expr in self.terms.itervalues())
+
+    def addObjective(self, name='Obj', sense=minimize):
+        objective = Objective(expr=self.expression(), sense=sense)
+        setattr(self.m, name, objective)
+        return objective
@@ -1,17 +1,30 @@
 import math
+import time
+import itertools
+import hashlib
+import json
 import numpy as np
-import matlab.engine
+import scipy.sparse
+try:
+    import matlab.engine
+except ImportError:
+    matlab = None
 from pyomo.environ import *
 from pyomo.dae import *
 from pyomo.gdp import *
 from pyomo.gdp.plugins.chull import ConvexHull_Transformation
 from pyomo.gdp.plugins.bigm import BigM_Transformation
 from pyomo.core import Var
+from pyomo.core.base import expr as EXPR
+from pyomo.repn import generate_canonical_repn
+from pyomo.util.plugin import alias
 from pyomo.dae.plugins.finitedifference import Finite_Difference_Transformation
 import hopperUtil
+from telemetry import nullTelemetry
+from terrain import Terrain
 
 class Hopper:
-    def __init__(self, N, eng, matlabHopper, name=''):
+    def __init__(self, N, eng=None, matlabHopper=None, name='', parameters=None, reformulation='hull'):
         self.model_disc = []
         self.positionMax = 10
         self.rotationMax = 2*np.pi
@@ -34,15 +47,42 @@ class Hopper:
         self.p_MDT = -2
         self.P_MDT = -1
         self.regions = []
+        # Compiled self.regions, see terrain()
+        self._terrain = None
         self.base = 10
         self.tf = 1
         self.nOrientationSectors = 1
+        # Segment selection of the piecewise-linear cos/sin of th: 'cc'
+        # (one Piecewise per function, a binary per sector) or 'log' (shared
+        # by both, log2 of the number of sectors binaries)
+        self.orientationEncoding = 'cc'
         self.bodyRadius = 0.25
         self.mdt_precision = 1
+        # Known initial position and lower bound on the final position (in
+        # leg lengths, None for free components). Only used to prune
+        # unreachable region disjuncts.
+        self.r0 = None
+        self.rfMin = None
+        self.platforms = []
+        self.reformulation = reformulation
+        # Wall-clock time of the phases inside constructPyomoModel
+        self.timings = {}
+        # Numbers of region disjuncts built and avoided by the last
+        # constructPyomoModel, see _regionCandidates
+        self.disjunctCounts = {}
+        # Replace with a telemetry.Telemetry to record stage timings and
+        # model sizes
+        self.telemetry = nullTelemetry
         self.eng = eng
         self.matlabHopper = matlabHopper
-        self.momentOfInertia = self.eng.getDimensionlessMomentOfInertia(self.matlabHopper)
-        self.hipOffset = self.eng.getHipInBody(self.matlabHopper)
+        if parameters is not None:
+            self.momentOfInertia = parameters.getDimensionlessMomentOfInertia()
+            self.hipOffset = parameters.getHipInBody()
+        elif self.eng is not None:
+            self.momentOfInertia = self.eng.getDimensionlessMomentOfInertia(self.matlabHopper)
+            self.hipOffset = self.eng.getHipInBody(self.matlabHopper)
+        else:
+            raise ValueError('Hopper needs either a MATLAB engine or a parameter provider')
         self.footnames = self.hipOffset.keys()
 
     def addPlatform(self, platform_start, platform_end, platform_height, mu, platform_left, platform_right):
@@ -50,7 +90,9 @@ class Hopper:
                        b=np.matrix('%f; %f' % (-(platform_start+0.1), platform_end-0.1)),
                        Aeq=np.array([0., 1.]), beq=platform_height, normal=np.matrix('0.; 1.'),
                        mu=mu)
-        self.eng.addPlatform(self.matlabHopper, platform_start, platform_end, platform_height, platform_left, platform_right, nargout=0)
+        self.platforms.append((platform_start, platform_end, platform_height, platform_left, platform_right))
+        if self.eng is not None:
+            self.eng.addPlatform(self.matlabHopper, *self.platforms[-1], nargout=0)
 
     def addFreeBlock(self, left=None, right=None, top=None, bottom=None):
         Arows = []
@@ -78,7 +120,23 @@ class Hopper:
             for key2 in self.regions[-1].keys():
                 if key == key2:
                     self.regions[-1][key] = value
-        forMatlab = dict(self.regions[-1])
+        self._terrain = None
+        if self.eng is not None:
+            self._addRegionToMatlab(self.regions[-1])
+
+    def loadTerrain(self, filename):
+        # Adds the regions of a terrain.Terrain file (.npz or .json)
+        for region in Terrain.load(filename).regions():
+            self.addRegion(**region)
+
+    def terrain(self):
+        # terrain.Terrain of the regions added so far, compiled on first use
+        if self._terrain is None:
+            self._terrain = Terrain.fromRegions(self.regions)
+        return self._terrain
+
+    def _addRegionToMatlab(self, region):
+        forMatlab = dict(region)
         for key, value in forMatlab.iteritems():
             if isinstance(value, type(np.array(0))):
                 forMatlab[key] = matlab.double(value.tolist())
@@ -86,10 +144,26 @@ class Hopper:
                 forMatlab[key] = matlab.double([])
         self.eng.addRegion(self.matlabHopper, forMatlab, nargout=0)
 
+    def attachVisualizer(self, eng, matlabHopper):
+        # Attach a MATLAB Hopper object to a headless Hopper and replay the
+        # terrain that was added so far.
+        self.eng = eng
+        self.matlabHopper = matlabHopper
+        for region in self.regions:
+            self._addRegionToMatlab(region)
+        for platform in self.platforms:
+            self.eng.addPlatform(self.matlabHopper, *platform, nargout=0)
+
+    def _checkVisualizer(self):
+        if self.eng is None:
+            raise RuntimeError('No MATLAB visualizer attached to this Hopper (see attachVisualizer)')
+
     def constructVisualizer(self):
+        self._checkVisualizer()
         self.eng.constructVisualizer(self.matlabHopper, nargout=0)
 
     def playback(self, speed=1.):
+        self._checkVisualizer()
         self.eng.playback(self.matlabHopper, speed, nargout=0)
 
     def extractTime(self, m):
@@ -123,34 +197,237 @@ class Hopper:
         return np.atleast_2d(np.array([self.momentOfInertia*m.w[ti].value for ti in m.t]))
 
     def extractRegionIndicators(self, m):
-        return np.dstack([np.vstack([np.array([getattr(m, '%sindicator_var' % m.footRegionConstraints[region, foot, ti].cname()).value for ti in m.t]) for region in m.REGION_INDEX]) for foot in m.feet])
+        return np.dstack([np.vstack([np.array([m.footRegionIndicators[region, foot, ti].value for ti in m.t]) for region in m.REGION_INDEX]) for foot in m.feet])
 
     def extractBodyRegionIndicators(self, m):
         def extractIndicatorForRegion(region):
             if self.regions[region]['mu'] == 0.0:
-                return np.array([getattr(m, '%sindicator_var' % m.bodyRegionConstraints[region, ti].cname()).value for ti in m.t])
+                return np.array([m.bodyRegionIndicators[region, ti].value for ti in m.t])
             else:
                 return np.zeros([1, len(m.t)])
 
         return np.vstack([extractIndicatorForRegion(region) for region in m.REGION_INDEX])
 
-    def loadResults(self, m):
-        data = dict()
-        data['t'] =                 matlab.double(self.extractTime(m).tolist())
-        data['r'] =                 matlab.double(self.extractPostition(m).tolist())
-        data['v'] =                 matlab.double(self.extractVelocity(m).tolist())
-        data['F'] =                 matlab.double(self.extractTotalForce(m).tolist())
-        data['th'] =                matlab.double(self.extractOrientation(m).tolist())
-        data['r_hip'] =             matlab.double(self.extractHipPosition(m).tolist())
-        data['p'] =                 matlab.double(self.extractRelativeFootPosition(m).tolist())
-        data['f'] =                 matlab.double(self.extractFootForce(m).tolist())
-        data['T'] =                 matlab.double(self.extractTotalTorque(m).tolist())
-        data['k'] =                 matlab.double(self.extractAngularMomentum(m).tolist())
-        data['region_indicators'] = matlab.double(self.extractRegionIndicators(m).tolist())
-        data['body_region_indicators'] = matlab.double(self.extractBodyRegionIndicators(m).tolist())
-        self.eng.loadResults(self.matlabHopper, data, nargout=0)
-
-    def constructPyomoModel(self):
+    def solutionDtype(self, nFeet, nRegions):
+        return np.dtype([('t', float),
+                         ('r', float, (2,)),
+                         ('v', float, (2,)),
+                         ('F', float, (2,)),
+                         ('th', float),
+                         ('r_hip', float, (2, nFeet)),
+                         ('p', float, (2, nFeet)),
+                         ('f', float, (2, nFeet)),
+                         ('T', float),
+                         ('k', float),
+                         ('region_indicators', float, (nRegions, nFeet)),
+                         ('body_region_indicators', float, (nRegions,))])
+
+    def _solutionVariables(self, m):
+        # Object arrays of the variable data read by extractSolution, in the
+        # (time x component x foot) layout of the solution records. They are
+        # built on first use and kept on the model (clones map them over).
+        variables = getattr(m, '_solutionVariables', None)
+        if variables is not None:
+            return variables
+        xz = list(m.R2_INDEX)
+        feet = list(m.feet)
+        t = list(m.t)
+        regions = list(m.REGION_INDEX)
+        variables = {'dt': _varArray(m.dt, t),
+                     'r': _varArray(m.r, xz, t).T,
+                     'v': _varArray(m.v, xz, t).T,
+                     'F': _varArray(m.F, xz, t).T,
+                     'th': _varArray(m.th, t),
+                     'r_hip': _varArray(m.hip, feet, xz, t).T,
+                     'p': _varArray(m.p, feet, xz, t).T,
+                     'f': _varArray(m.f, feet, xz, t).T,
+                     'T': _varArray(m.T, t),
+                     'w': _varArray(m.w, t)}
+        indicators = np.empty((len(t), len(regions), len(feet)), dtype=object)
+        for (k, ti), (j, region), (i, foot) in itertools.product(enumerate(t), enumerate(regions), enumerate(feet)):
+            indicators[k, j, i] = m.footRegionIndicators[region, foot, ti]
+        variables['region_indicators'] = indicators
+        variables['body_regions'] = [j for j, region in enumerate(regions) if self.regions[region]['mu'] == 0.0]
+        indicators = np.empty((len(t), len(variables['body_regions'])), dtype=object)
+        for (k, ti), (j, region) in itertools.product(enumerate(t), enumerate(variables['body_regions'])):
+            indicators[k, j] = m.bodyRegionIndicators[region, ti]
+        variables['body_region_indicators'] = indicators
+        m._solutionVariables = variables
+        return variables
+
+    def extractSolution(self, m, solution=None):
+        # One pass over the variable data of m into a structured array with
+        # one record per time step (preallocate with solutionDtype to reuse
+        # a buffer). Missing values are stored as NaN.
+        variables = self._solutionVariables(m)
+        if solution is None:
+            solution = np.zeros(len(m.t), dtype=self.solutionDtype(len(m.feet), len(m.REGION_INDEX)))
+
+        def _values(field):
+            return np.array([var.value for var in variables[field].flat], dtype=float).reshape(variables[field].shape)
+
+        solution['t'][0] = 0.
+        solution['t'][1:] = np.cumsum(_values('dt')[:-1])
+        for field in ['r', 'v', 'F', 'th', 'r_hip', 'p', 'f', 'T', 'region_indicators']:
+            solution[field] = _values(field)
+        solution['k'] = self.momentOfInertia*_values('w')
+        solution['body_region_indicators'] = 0.
+        solution['body_region_indicators'][:, variables['body_regions']] = _values('body_region_indicators')
+        return solution
+
+    def solutionViews(self, solution):
+        # Views of an extractSolution() array in the layout of the extract*
+        # methods (component x time x foot); none of them copy data.
+        return {'t': solution['t'],
+                'r': solution['r'].T,
+                'v': solution['v'].T,
+                'F': solution['F'].T,
+                'th': solution['th'][np.newaxis, :],
+                'r_hip': solution['r_hip'].transpose(1, 0, 2),
+                'p': solution['p'].transpose(1, 0, 2),
+                'f': solution['f'].transpose(1, 0, 2),
+                'T': solution['T'][np.newaxis, :],
+                'k': solution['k'][np.newaxis, :],
+                'region_indicators': solution['region_indicators'].transpose(1, 0, 2),
+                'body_region_indicators': solution['body_region_indicators'].T}
+
+    def loadResults(self, m, store=None, key=None, metadata=None):
+        # Extracts the solution of m, saves it in a planStore.PlanStore when
+        # one is given and passes it on to the MATLAB Hopper.
+        solution = self.extractSolution(m)
+        if store is not None:
+            store.put(key, solution, self, metadata)
+        self.loadSolution(solution)
+        return solution
+
+    def loadSolution(self, solution):
+        # Sends an extractSolution() array (e.g. one read from a PlanStore)
+        # to the MATLAB Hopper, if there is one.
+        if self.eng is not None:
+            data = dict()
+            for key, view in self.solutionViews(solution).iteritems():
+                data[key] = matlab.double(view.tolist())
+            self.eng.loadResults(self.matlabHopper, data, nargout=0)
+
+    def seedSolution(self, m, solution, trajectory=True):
+        # Sets the indicator variables of m (and, with trajectory=True, the
+        # variables stored in the solution records) from an extractSolution()
+        # array or a .npy file holding one, e.g. as a MIP start for
+        # opt.solve(m, warmstart=True). Fixed variables and NaNs are skipped.
+        if isinstance(solution, basestring):
+            solution = np.load(solution)
+        variables = self._solutionVariables(m)
+        fields = ['region_indicators']
+        if trajectory:
+            fields += ['r', 'v', 'F', 'th', 'r_hip', 'p', 'f', 'T']
+            _setValues(variables['dt'][:-1], np.diff(solution['t']))
+            _setValues(variables['w'], solution['k']/self.momentOfInertia)
+        for field in fields:
+            _setValues(variables[field], solution[field])
+        _setValues(variables['body_region_indicators'],
+                   solution['body_region_indicators'][:, variables['body_regions']])
+
+    def seedFromModel(self, m, source, trajectory=True):
+        # Seeds m from the current values of another model over the same
+        # terrain and horizon, e.g. the previous plan.
+        self.seedSolution(m, self.extractSolution(source), trajectory)
+
+    def seedContactHeuristic(self, m):
+        # Seeds the indicator variables with a contact schedule along a
+        # straight-line path from r0 to rfMin: each foot lands on the contact
+        # region nearest its hip, stays there until the hip has moved a leg
+        # length away, then swings through the free region above for one
+        # step. Feet start and end in contact. Only the candidate regions of
+        # each foot (or the body) and step are chosen, see _regionCandidates.
+        if self.r0 is None or self.rfMin is None or self.r0[0] is None or self.rfMin[0] is None:
+            raise ValueError('seedContactHeuristic needs r0 and rfMin in x')
+        variables = self._solutionVariables(m)
+        regions = list(m.REGION_INDEX)
+        extents = [self._regionExtent(region) for region in regions]
+        contactRegions = [j for j, region in enumerate(regions)
+                          if self.regions[region]['mu'] != 0. and extents[j] is not None]
+        freeRegions = [j for j in variables['body_regions'] if extents[j] is not None]
+
+        t = list(m.t)
+
+        def _candidate(j, foot, k):
+            if foot is None:
+                return (regions[j], t[k]) in m.BODY_REGION_INDEX
+            return (regions[j], foot, t[k]) in m.FOOT_REGION_INDEX
+
+        def _nearest(x, preferred, foot, k):
+            # Nearest candidate region to x, from preferred if there is one
+            for group in (preferred, contactRegions + freeRegions):
+                candidates = [j for j in group if _candidate(j, foot, k)]
+                if candidates:
+                    return min(candidates, key=lambda j: max(extents[j][0][0] - x, x - extents[j][1][0], 0.))
+            raise ValueError('No candidate region at step %d' % t[k])
+
+        x = np.linspace(self.r0[0], self.rfMin[0], len(m.t))
+        nT = len(m.t)
+        footIndicators = np.zeros((nT, len(regions), len(m.feet)))
+        for i, foot in enumerate(m.feet):
+            stance = None
+            for k in range(nT):
+                hip = x[k] + self.hipOffset[foot]['x']
+                if stance is not None and abs(hip - stance[1]) <= 1. and _candidate(stance[0], foot, k):
+                    footIndicators[k, stance[0], i] = 1.
+                elif stance is not None and k < nT - 1:
+                    footIndicators[k, _nearest(hip, freeRegions, foot, k), i] = 1.
+                    stance = None
+                else:
+                    region = _nearest(hip, contactRegions, foot, k)
+                    stance = (region, hip)
+                    footIndicators[k, region, i] = 1.
+        bodyIndicators = np.zeros((nT, len(variables['body_regions'])))
+        for k in range(nT):
+            bodyIndicators[k, variables['body_regions'].index(_nearest(x[k], freeRegions, None, k))] = 1.
+        _setValues(variables['region_indicators'], footIndicators)
+        _setValues(variables['body_region_indicators'], bodyIndicators)
+
+    def terrainDescription(self):
+        # The regions with their arrays as nested lists, e.g. for JSON. The
+        # layout does not depend on the shapes the regions were added with
+        # (A and Aeq as lists of rows, the rest as flat lists and mu as a
+        # number), so that equal terrains give equal model keys.
+        description = []
+        for region in self.regions:
+            description.append(dict((key, None if value is None else _plainArray(np.atleast_2d(value)
+                                                                                 if key in ('A', 'Aeq')
+                                                                                 else np.ravel(value)))
+                                    for key, value in region.iteritems()))
+            description[-1]['mu'] = float(region['mu'] or 0.)
+        return description
+
+    def modelKey(self, prune=True, **options):
+        # Hash of everything constructPyomoModel(prune=prune) depends on, plus
+        # any extra options describing how the model is transformed
+        # afterwards. r0 and rfMin only matter to pruned models.
+        description = dict(options, prune=prune)
+        if prune:
+            description.update(r0=self.r0, rfMin=self.rfMin)
+        description.update(N=self.N, positionMax=self.positionMax, rotationMax=self.rotationMax,
+                           velocityMax=self.velocityMax, angularVelocityMax=self.angularVelocityMax,
+                           forceMax=self.forceMax, dtBounds=_plainArray(self.dtBounds), dtNom=self.dtNom,
+                           nOrientationSectors=self.nOrientationSectors,
+                           orientationEncoding=self.orientationEncoding, bodyRadius=self.bodyRadius,
+                           reformulation=self.reformulation,
+                           momentOfInertia=self.momentOfInertia, hipOffset=self.hipOffset,
+                           regions=self.terrainDescription())
+        return hashlib.sha1(json.dumps(description, sort_keys=True)).hexdigest()
+
+    def constructPyomoModel(self, assembly='rules', prune=True):
+        with self.telemetry.stage('constructPyomoModel'):
+            model = self._constructPyomoModel(assembly, prune)
+        return model
+
+    def _constructPyomoModel(self, assembly, prune):
+        if assembly not in ('rules', 'arrays'):
+            raise ValueError("Unknown model assembly '%s'" % assembly)
+        if self.reformulation not in ('hull', 'bigm', 'hybrid'):
+            raise ValueError("Unknown disjunction reformulation '%s'" % self.reformulation)
+        if self.orientationEncoding not in ('cc', 'log'):
+            raise ValueError("Unknown orientation encoding '%s'" % self.orientationEncoding)
         model = ConcreteModel()
         model.R2_INDEX = Set(initialize=['x', 'z'])
         model.feet = Set(initialize=self.footnames)
@@ -158,21 +435,11 @@ class Hopper:
         model.t = RangeSet(1, self.N)
         model.BV_INDEX = RangeSet(0, 1)
 
-        def _bvRule(m, region, bv, xz):
-            # v = rot(+-atan(mu))*normal
-            mu = self.regions[region]['mu']
-            if bv == m.BV_INDEX[1]:
-                theta = np.arctan(mu)
-            else:
-                theta = -np.arctan(mu)
-            R = np.matrix([[cos(theta), -sin(theta)],
-                          [sin(theta),  cos(theta)]])
-            vec = R*(self.regions[region]['normal'])
-            if xz == 'x':
-                return float(vec[0])
-            else:
-                return float(vec[1])
-        model.basisVectors = Param(model.REGION_INDEX, model.BV_INDEX, model.R2_INDEX, initialize=_bvRule)
+        terrain = self.terrain()
+        basisVectors = dict(((region, bv, xz), float(terrain.basisVectors[region, bv, i]))
+                            for region in model.REGION_INDEX for bv in model.BV_INDEX
+                            for i, xz in enumerate(['x', 'z']))
+        model.basisVectors = Param(model.REGION_INDEX, model.BV_INDEX, model.R2_INDEX, initialize=basisVectors)
 
         def _hipOffsetRule(m, foot, xz):
             return self.hipOffset[foot][xz]
@@ -219,9 +486,161 @@ class Hopper:
         def _sin(model, t, th):
             return sin(th)
 
-        model.pwCos = Piecewise(model.t, model.cth, model.th, pw_pts=bpts, pw_constr_type='EQ', pw_repn='CC', f_rule=_cos)
-        model.pwSin = Piecewise(model.t, model.sth, model.th, pw_pts=bpts, pw_constr_type='EQ', pw_repn='CC', f_rule=_sin)
+        if self.orientationEncoding == 'log':
+            model.pwTrig = Block()
+            _addLogPiecewise(model.pwTrig, model.t, model.th, [(model.cth, math.cos), (model.sth, math.sin)], bpts)
+        else:
+            model.pwCos = Piecewise(model.t, model.cth, model.th, pw_pts=bpts, pw_constr_type='EQ', pw_repn='CC', f_rule=_cos)
+            model.pwSin = Piecewise(model.t, model.sth, model.th, pw_pts=bpts, pw_constr_type='EQ', pw_repn='CC', f_rule=_sin)
+
+        # Models whose boundary conditions change later must keep every disjunct
+        with self.telemetry.stage('prune') as stage:
+            footCandidates, bodyCandidates = self._regionCandidates(model, prune)
+            stage.extra.update(self.disjunctCounts)
+        model.FOOT_REGION_INDEX = Set(dimen=3, ordered=True,
+                                      initialize=[(region, foot, t) for region in model.REGION_INDEX
+                                                  for foot in model.feet for t in model.t
+                                                  if region in footCandidates[foot, t]])
+        model.BODY_REGION_INDEX = Set(dimen=2, ordered=True,
+                                      initialize=[(region, t) for region in model.REGION_INDEX for t in model.t
+                                                  if region in bodyCandidates[t]])
+
+        # For the hull, the array assembly reformulates the disjunctions
+        # itself, straight from its coefficient blocks (see _addHull), and
+        # builds no Disjuncts.
+        footHull = bodyHull = assembly == 'arrays' and self.reformulation == 'hull'
+        with self.telemetry.stage('constraints'):
+            if assembly == 'arrays':
+                footConstraints, bodyConstraints, columns = self._constructArrayConstraints(model)
+                if not footHull:
+                    def _footRegionConstraints(disjunct, region, foot, t):
+                        _addArrayDisjunct(disjunct, footConstraints[region, foot, t])
+                    model.footRegionConstraints = Disjunct(model.FOOT_REGION_INDEX, rule=_footRegionConstraints)
+                if not bodyHull:
+                    def _bodyRegionConstraints(disjunct, region, t):
+                        _addArrayDisjunct(disjunct, bodyConstraints[region, t])
+                    model.bodyRegionConstraints = Disjunct(model.BODY_REGION_INDEX, rule=_bodyRegionConstraints)
+            else:
+                self._constructRuleConstraints(model)
+
+        # Define the disjunction
+        def _footRegionDisjunction(m, foot, t):
+            disjunctList = []
+            for region in footCandidates[foot, t]:
+                disjunctList.append(m.footRegionConstraints[region, foot, t])
+            return disjunctList
+        if not footHull and self.reformulation != 'hybrid':
+            model.footRegionDisjunction = Disjunction(model.feet, model.t, rule=_footRegionDisjunction)
+
+        # Define the disjunction
+        def _bodyRegionDisjunction(m, t):
+            disjunctList = []
+            for region in bodyCandidates[t]:
+                disjunctList.append(m.bodyRegionConstraints[region, t])
+            return disjunctList
+        if not bodyHull:
+            model.bodyRegionDisjunction = Disjunction(model.t, rule=_bodyRegionDisjunction)
+
+        # The transformation moves the indicator variables out of their
+        # disjuncts, so grab them first and index them by (region, foot, t)
+        # and (region, t) once it is done. Regions that are not candidates
+        # share one indicator fixed to zero. The hull of the array assembly
+        # gets indicators under the names the transformation would give them.
+        model.absentRegionIndicator = Var(within=Binary)
+        model.absentRegionIndicator.fix(0)
+        footRegionIndicators = dict(((region, foot, t), model.absentRegionIndicator)
+                                    for region in model.REGION_INDEX for foot in model.feet for t in model.t)
+        bodyRegionIndicators = dict(((region, t), model.absentRegionIndicator)
+                                    for region in model.REGION_INDEX for t in model.t)
+        if footHull:
+            for index in model.FOOT_REGION_INDEX:
+                footRegionIndicators[index] = Var(within=Binary)
+                model.add_component('footRegionConstraints[%s,%s,%s]indicator_var' % index,
+                                    footRegionIndicators[index])
+        else:
+            footRegionIndicators.update((index, disjunct.indicator_var)
+                                        for index, disjunct in model.footRegionConstraints.iteritems())
+        if bodyHull:
+            for index in model.BODY_REGION_INDEX:
+                bodyRegionIndicators[index] = Var(within=Binary)
+                model.add_component('bodyRegionConstraints[%s,%s]indicator_var' % index,
+                                    bodyRegionIndicators[index])
+        else:
+            bodyRegionIndicators.update((index, disjunct.indicator_var)
+                                        for index, disjunct in model.bodyRegionConstraints.iteritems())
+
+        # 'hybrid' uses the hull only for the contact regions of the foot
+        # disjunctions (see _addHybridHull) and big-M for everything else.
+        t0 = time.time()
+        with self.telemetry.stage('transform'):
+            if footHull:
+                model._gdp_relax_chull = Block()
+                model._gdp_relax_chull.footRegionDisjunction = Constraint(model.feet, model.t)
+                for foot in model.feet:
+                    for t in model.t:
+                        disjuncts = []
+                        for region in footCandidates[foot, t]:
+                            name = 'footRegionConstraints[%s,%s,%s]' % (region, foot, t)
+                            disjuncts.append((name, [footRegionIndicators[region, foot, t]],
+                                              _blockRows(name, footConstraints[region, foot, t])))
+                        _addHull(model, model._gdp_relax_chull.footRegionDisjunction, (foot, t),
+                                 'footRegionDisjunction.[%s,%s]' % (foot, t), disjuncts, columns.name)
+                model._gdp_relax_chull.bodyRegionDisjunction = Constraint(model.t)
+                for t in model.t:
+                    disjuncts = []
+                    for region in bodyCandidates[t]:
+                        name = 'bodyRegionConstraints[%s,%s]' % (region, t)
+                        disjuncts.append((name, [bodyRegionIndicators[region, t]],
+                                          _blockRows(name, bodyConstraints[region, t])))
+                    _addHull(model, model._gdp_relax_chull.bodyRegionDisjunction, t,
+                             'bodyRegionDisjunction.%s' % t, disjuncts, columns.name)
+            elif self.reformulation == 'hull':
+                ConvexHull_Transformation().apply_to(model)
+            else:
+                self._addBigMSuffixes(model)
+                if self.reformulation == 'hybrid':
+                    self._addHybridHull(model, footCandidates)
+                _BigM_Transformation().apply_to(model)
+        self.timings['transform'] = time.time() - t0
+        self.telemetry.count('transform', model)
+
+        model.footRegionIndicators = footRegionIndicators
+        model.bodyRegionIndicators = bodyRegionIndicators
+
+        def _stanceDurationRule(m, foot, region, t):
+            window = 2
+            if not terrain.free[region]:
+                t_start = max(1, t - window)
+                t_end = min(m.t[-1], t + window) + 1
+                indicators = [m.footRegionIndicators[region, foot, ti] for ti in range(t_start, t_end)]
+                current_indicator = m.footRegionIndicators[region, foot, t]
+                bigM = window + 1
+                return -sum(indicators) <= -bigM + bigM*(1 - current_indicator)
+            else:
+                return Constraint.Skip
+        #model.stanceDurationConstraint = Constraint(model.feet, model.REGION_INDEX, model.t, rule=_stanceDurationRule)
+
+        def _initialStance(m, foot, region):
+            if (region, foot, m.t[1]) in m.FOOT_REGION_INDEX and terrain.free[region]:
+                current_indicator = m.footRegionIndicators[region, foot, m.t[1]]
+                return current_indicator == 0
+            else:
+                return Constraint.Skip
+
+        model.initialStance = Constraint(model.feet, model.REGION_INDEX, rule=_initialStance)
+
+        def _finalStance(m, foot, region):
+            if (region, foot, m.t[-1]) in m.FOOT_REGION_INDEX and terrain.free[region]:
+                current_indicator = m.footRegionIndicators[region, foot, m.t[-1]]
+                return current_indicator == 0
+            else:
+                return Constraint.Skip
 
+        model.finalStance = Constraint(model.feet, model.REGION_INDEX, rule=_finalStance)
+
+        return model
+
+    def _constructRuleConstraints(self, model):
         def _momentRule(m, t):
             return m.T[t] == -sum(m.footRelativeToCOM[foot,'x',t]*m.f[foot,'z',t] - m.footRelativeToCOM[foot,'z',t]*m.f[foot, 'x',t] for foot in m.feet)
             #return m.T[t] == sum(m.footRelativeToCOM[foot,'x',t]*m.f[foot,'z',t] - m.footRelativeToCOM[foot,'z',t]*m.f[foot, 'x',t] for foot in m.feet)
@@ -317,23 +736,11 @@ class Hopper:
 
         model.orientationConstraint = Constraint(model.t, rule=_orientationRule)
 
+        terrain = self.terrain()
+
         def _footRegionConstraints(disjunct, region, foot, t):
             m = disjunct.model()
-            A = None
-            if self.regions[region]['A'] is not None:
-                A = self.regions[region]['A']
-                b = self.regions[region]['b']
-            if self.regions[region]['Aeq'] is not None:
-                Aeq = self.regions[region]['Aeq']
-                beq = self.regions[region]['beq']
-                if A is not None:
-                    A = np.vstack((A, Aeq, -Aeq))
-                    b = np.vstack((b, beq, -beq))
-                else:
-                    A = np.vstack((Aeq, -Aeq))
-                    b = np.vstack((beq, -beq))
-            A = np.atleast_2d(A)
-            b = np.atleast_1d(b)
+            A, b = terrain.stacked(region)
             def _contactPositionConstraint(disjunctData, i):
                 m = disjunctData.model()
                 return A[i,0]*m.foot[foot, 'x', t] + A[i,1]*m.foot[foot, 'z', t] <= float(b[i])
@@ -341,14 +748,14 @@ class Hopper:
 
             def _footCollisionAvoidanceConstraint(disjunctData, i, pm1):
                 m = disjunctData.model()
-                if self.regions[region]['mu'] == 0. and t != m.t[-1] and t != m.t[1]:
+                if terrain.free[region] and t != m.t[-1] and t != m.t[1]:
                     return A[i,0]*m.foot[foot, 'x', t+pm1] + A[i,1]*m.foot[foot, 'z', t+pm1] <= float(b[i])
                 else:
                     return Constraint.Skip
             disjunct.footCollisionAvoidanceConstraint = Constraint(range(A.shape[0]), [-1, 1], rule=_footCollisionAvoidanceConstraint)
 
             def _hipPositionConstraint(disjunctData, i):
-                if self.regions[region]['mu'] == 0.:
+                if terrain.free[region]:
                     m = disjunctData.model()
                     return A[i,0]*(m.r['x', t] + m.hip[foot, 'x', t]) + A[i,1]*(m.r['z', t] + m.hip[foot, 'z', t]) <= float(b[i])
                 else:
@@ -373,7 +780,7 @@ class Hopper:
 
             def _stationaryFootConstraint(disjunctData, xz):
                 m = disjunctData.model()
-                if self.regions[region]['mu'] != 0.:
+                if not terrain.free[region]:
                     if xz == 'x':
                         return m.pd[foot, xz, t] == 0
                     else:
@@ -383,81 +790,651 @@ class Hopper:
             disjunct.stationaryFootConstraint = Constraint(m.R2_INDEX, rule=_stationaryFootConstraint)
 
 
-        model.footRegionConstraints = Disjunct(model.REGION_INDEX, model.feet, model.t, rule=_footRegionConstraints)
-
-        # Define the disjunction
-        def _footRegionDisjunction(m, foot, t):
-            disjunctList = []
-            for region in m.REGION_INDEX:
-                disjunctList.append(m.footRegionConstraints[region, foot, t])
-            return disjunctList
-        model.footRegionDisjunction = Disjunction(model.feet, model.t, rule=_footRegionDisjunction)
+        model.footRegionConstraints = Disjunct(model.FOOT_REGION_INDEX, rule=_footRegionConstraints)
 
         def _bodyRegionConstraints(disjunct, region, t):
-            if self.regions[region]['mu'] != 0.:
+            if not terrain.free[region]:
                 return Constraint.Skip
             else:
                 m = disjunct.model()
-                A = None
-                if self.regions[region]['A'] is not None:
-                    A = self.regions[region]['A']
-                    b = self.regions[region]['b'] - self.bodyRadius
-                A = np.atleast_2d(A)
-                b = np.atleast_1d(b)
+                A, b = terrain.inequalities(region)
+                b = b - self.bodyRadius
                 def _bodyPositionConstraint(disjunctData, i):
                     m = disjunctData.model()
                     return A[i,0]*m.r['x', t] + A[i,1]*m.r['z', t] <= float(b[i])
                 disjunct.bodyPositionConstraint = Constraint(range(A.shape[0]), rule=_bodyPositionConstraint)
 
 
-        model.bodyRegionConstraints = Disjunct(model.REGION_INDEX, model.t, rule=_bodyRegionConstraints)
+        model.bodyRegionConstraints = Disjunct(model.BODY_REGION_INDEX, rule=_bodyRegionConstraints)
+
+    def reachablePositions(self, speed=None, reach=0.):
+        # Interval bounds (N x 2 arrays of lower and upper values) on a
+        # position that starts within reach of r0, ends within reach of
+        # rfMin and moves at most speed*dtBounds[1] per step in x and z.
+        if speed is None:
+            speed = self.velocityMax
+        step = speed*self.dtBounds[1]
+        steps = np.arange(self.N)
+        lower = -(self.positionMax + reach)*np.ones((self.N, 2))
+        upper = (self.positionMax + reach)*np.ones((self.N, 2))
+        for i in range(2):
+            if self.r0 is not None and self.r0[i] is not None:
+                lower[:, i] = np.maximum(lower[:, i], self.r0[i] - reach - step*steps)
+                upper[:, i] = np.minimum(upper[:, i], self.r0[i] + reach + step*steps)
+            if self.rfMin is not None and self.rfMin[i] is not None:
+                lower[:, i] = np.maximum(lower[:, i], self.rfMin[i] - reach - step*steps[::-1])
+        return lower, upper
+
+    def _regionCandidates(self, model, prune=True):
+        # Regions each foot and the body may be in at every time step, as
+        # dicts from (foot, t) and t to arrays of regions. With prune, these
+        # are the regions whose bounding box meets the positions reachable
+        # from r0 and rfMin (see reachablePositions); the disjunctions are
+        # then only built over them. The counts of built and avoided
+        # disjuncts are kept in self.disjunctCounts.
+        terrain = self.terrain()
+        allRegions = np.arange(terrain.nRegions)
+        footCandidates = dict(((foot, t), allRegions) for foot in model.feet for t in model.t)
+        bodyCandidates = dict((t, allRegions[terrain.free]) for t in model.t)
+        if prune and (self.r0 is not None or self.rfMin is not None):
+            bodyLower, bodyUpper = self.reachablePositions()
+            # The feet stay within footReach of the body and move with pd.
+            footReach = max(max(abs(bound) for bound in var.bounds) for var in model.footRelativeToCOM.itervalues())
+            footSpeed = max(max(abs(bound) for bound in var.bounds) for var in model.pd.itervalues())
+            footLower, footUpper = self.reachablePositions(footSpeed, footReach)
+            footLower = np.maximum(footLower, bodyLower - footReach)
+            footUpper = np.minimum(footUpper, bodyUpper + footReach)
+            for k, t in enumerate(model.t):
+                regions = terrain.overlapping(footLower[k], footUpper[k], self.positionMax)
+                for foot in model.feet:
+                    footCandidates[foot, t] = regions
+                bodyCandidates[t] = terrain.overlapping(bodyLower[k], bodyUpper[k], self.positionMax,
+                                                        self.bodyRadius, freeOnly=True)
+        for name, candidates in [('foot', footCandidates), ('body', bodyCandidates)]:
+            if any(len(regions) == 0 for regions in candidates.itervalues()):
+                raise ValueError('No %s region is reachable at some time step' % name)
+        footBuilt = sum(len(regions) for regions in footCandidates.itervalues())
+        bodyBuilt = sum(len(regions) for regions in bodyCandidates.itervalues())
+        self.disjunctCounts = {'footDisjuncts': footBuilt,
+                               'footDisjunctsAvoided': len(footCandidates)*terrain.nRegions - footBuilt,
+                               'bodyDisjuncts': bodyBuilt,
+                               'bodyDisjunctsAvoided': len(bodyCandidates)*np.count_nonzero(terrain.free) - bodyBuilt}
+        return footCandidates, bodyCandidates
+
+    def _regionExtent(self, region, shrink=0.):
+        # Bounding box (lower, upper) of the region within the position
+        # bounds, or None if that set is empty.
+        return self.terrain().extent(region, self.positionMax, shrink)
+
+    def _regionSupport(self, a, region, shrink=0.):
+        # max a*x over the region (with b reduced by shrink) intersected
+        # with the position bounds, or None if that set is empty.
+        return self.terrain().support(a, region, self.positionMax, shrink)
+
+    def _bigM(self, A, b, regions, shrink=0.):
+        # Tightest upper M for each row of A*x <= b that holds whenever x
+        # lies in one of the given regions.
+        M = []
+        for a, bi in zip(A, b):
+            support = [self._regionSupport(a, region, shrink) for region in regions]
+            support = [value for value in support if value is not None]
+            M.append((None, max(max(support), float(bi)) if support else float(bi)))
+        return M
+
+    def _addBigMSuffixes(self, model):
+        # BigM_Transformation takes a list of (lower, upper) M values per
+        # constraint, consumed in the order of constraint._data. Rows that
+        # only involve foot or body positions get M from the other regions'
+        # polytopes; everything else is left to the bound-based estimate.
+        regions = list(model.REGION_INDEX)
+        terrain = self.terrain()
+        freeRegions = [region for region in regions if terrain.free[region]]
+
+        def _setBigM(disjunct, constraint, M):
+            if constraint is not None:
+                if 'BigM' not in disjunct.component_map(Suffix):
+                    disjunct.BigM = Suffix(direction=Suffix.LOCAL)
+                disjunct.BigM[constraint] = [M.get(index, (None, None)) for index in constraint._data]
+
+        for region in regions:
+            A, b = terrain.stacked(region)
+            contactM = dict(enumerate(self._bigM(A, b, [other for other in regions if other != region])))
+            collisionM = dict(((i, pm1), M) for i, M in enumerate(self._bigM(A, b, regions)) for pm1 in [-1, 1])
+            for foot in model.feet:
+                for t in model.t:
+                    if (region, foot, t) not in model.FOOT_REGION_INDEX:
+                        continue
+                    disjunct = model.footRegionConstraints[region, foot, t]
+                    _setBigM(disjunct, disjunct.component('contactPositionConstraint'), contactM)
+                    _setBigM(disjunct, disjunct.component('footCollisionAvoidanceConstraint'), collisionM)
+
+        for region in freeRegions:
+            A, b = terrain.inequalities(region)
+            b = b - self.bodyRadius
+            bodyM = dict(enumerate(self._bigM(A, b, [other for other in freeRegions if other != region],
+                                              shrink=self.bodyRadius)))
+            for t in model.t:
+                if (region, t) not in model.BODY_REGION_INDEX:
+                    continue
+                disjunct = model.bodyRegionConstraints[region, t]
+                _setBigM(disjunct, disjunct.component('bodyPositionConstraint'), bodyM)
+
+    def _addHybridHull(self, model, footCandidates):
+        # Hull of the foot disjunctions over their contact regions, with
+        # all free regions as one more disjunct whose copies are only
+        # bounded by the sum of their indicators. The free region disjuncts
+        # are relaxed with big-M on the original variables instead, so the
+        # hull only copies the variables once per contact region.
+        free = self.terrain().free
+        model._gdp_relax_chull = Block()
+        model._gdp_relax_chull.footRegionDisjunction = Constraint(model.feet, model.t)
+        bigM = _BigM_Transformation()
+        for foot in model.feet:
+            for t in model.t:
+                freeIndicators = []
+                disjuncts = []
+                for region in footCandidates[foot, t]:
+                    disjunct = model.footRegionConstraints[region, foot, t]
+                    indicator = disjunct.indicator_var
+                    if free[region]:
+                        freeIndicators.append(indicator)
+                        bigM.relaxDisjunct(disjunct)
+                        continue
+                    name = 'footRegionConstraints[%s,%s,%s]' % (region, foot, t)
+                    disjuncts.append((name, [indicator], _disjunctRows(name, disjunct)))
+                    disjunct.del_component(indicator)
+                    model.add_component(name + 'indicator_var', indicator)
+                    disjunct.deactivate()
+                if freeIndicators:
+                    disjuncts.append(('footFreeRegions[%s,%s]' % (foot, t), freeIndicators, []))
+                _addHull(model, model._gdp_relax_chull.footRegionDisjunction, (foot, t),
+                         'footRegionDisjunction.[%s,%s]' % (foot, t), disjuncts, lambda var: var.cname(True))
+
+    def _constructArrayConstraints(self, model):
+        # Same constraints as _constructRuleConstraints, but every family is
+        # a _RowBlock of sparse coefficients over the columns of the model's
+        # variables, whose rows are turned into flat sums in one pass. The
+        # region constraints are assembled once per region for all feet and
+        # time steps; returns the (name, index sets, indices, block, rows) of
+        # the constraints of every foot and body disjunct, from which
+        # _addArrayDisjunct or _addHull build them, and the _Columns.
+        xz = list(model.R2_INDEX)
+        feet = list(model.feet)
+        t = list(model.t)
+        nFeet, nT = len(feet), len(t)
+        x, z = xz.index('x'), xz.index('z')
+
+        columns = _Columns()
+        dt = columns.add(model.dt, t)
+        th = columns.add(model.th, t)
+        w = columns.add(model.w, t)
+        T = columns.add(model.T, t)
+        cth = columns.add(model.cth, t)
+        sth = columns.add(model.sth, t)
+        r = columns.add(model.r, xz, t)
+        v = columns.add(model.v, xz, t)
+        F = columns.add(model.F, xz, t)
+        f = columns.add(model.f, feet, xz, t)
+        beta = columns.add(model.beta, feet, list(model.BV_INDEX), t)
+        p = columns.add(model.p, feet, xz, t)
+        pd = columns.add(model.pd, feet, xz, t)
+        pdd = columns.add(model.pdd, feet, xz, t)
+        hip = columns.add(model.hip, feet, xz, t)
+        frc = columns.add(model.footRelativeToCOM, feet, xz, t)
+        foot = columns.add(model.foot, feet, xz, t)
+        transitions = t[:-1]
+
+        model.momentAbountCOM = Constraint(model.t)
+        rows = _RowBlock(columns, (nT,), 0.)
+        rows.add(T)
+        rows.addProducts(frc[:, x, :], f[:, z, :])
+        rows.addProducts(frc[:, z, :], f[:, x, :], -1.)
+        rows.addTo(model.momentAbountCOM, t)
+
+        model.totalForce = Constraint(model.R2_INDEX, model.t)
+        g = np.zeros((len(xz), 1))
+        g[z] = -1
+        rows = _RowBlock(columns, (len(xz), nT), g)
+        rows.add(F)
+        rows.add(f, -1.)
+        rows.addTo(model.totalForce, itertools.product(xz, t))
 
-        # Define the disjunction
-        def _bodyRegionDisjunction(m, t):
-            disjunctList = []
-            for region in m.REGION_INDEX:
-                if self.regions[region]['mu'] == 0.:
-                    disjunctList.append(m.bodyRegionConstraints[region, t])
-            return disjunctList
-        model.bodyRegionDisjunction = Disjunction(model.t, rule=_bodyRegionDisjunction)
-
-        disjunctionTransform = ConvexHull_Transformation()
-#         disjunctionTransform = BigM_Transformation()
-        disjunctionTransform.apply_to(model)
-
-        def _stanceDurationRule(m, foot, region, t):
-            window = 2
-            if self.regions[region]['mu'] != 0.:
-                t_start = max(1, t - window)
-                t_end = min(m.t[-1], t + window) + 1
-                indicators = [getattr(m, 'footRegionConstraints[%d,%s,%d]indicator_var' % (region, foot, ti))
-                              for ti in range(t_start, t_end)]
-                current_indicator = getattr(m, 'footRegionConstraints[%d,%s,%d]indicator_var' % (region, foot, t))
-                bigM = window + 1
-                return -sum(indicators) <= -bigM + bigM*(1 - current_indicator)
-            else:
-                return Constraint.Skip
-        #model.stanceDurationConstraint = Constraint(model.feet, model.REGION_INDEX, model.t, rule=_stanceDurationRule)
+        # Translational dynamics
+        model.positionConstraint = Constraint(model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (len(xz), nT - 1), 0.)
+        rows.add(r[:, 1:])
+        rows.add(r[:, :-1], -1.)
+        rows.addProducts(dt[:-1], v[:, 1:], -1.)
+        rows.addTo(model.positionConstraint, itertools.product(xz, transitions))
+
+        model.footPositionDefinition = Constraint(model.feet, model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (nFeet, len(xz), nT), 0.)
+        rows.add(foot)
+        rows.add(p, -1.)
+        rows.add(hip, -1.)
+        rows.add(r, -1.)
+        rows.addTo(model.footPositionDefinition, itertools.product(feet, xz, t))
+
+        model.footPositionConstraint = Constraint(model.feet, model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (nFeet, len(xz), nT - 1), 0.)
+        rows.add(foot[:, :, 1:])
+        rows.add(foot[:, :, :-1], -1.)
+        rows.addProducts(dt[:-1], pd[:, :, 1:], -1.)
+        rows.addTo(model.footPositionConstraint, itertools.product(feet, xz, transitions))
+
+        model.footRelativeToCOMDefinition = Constraint(model.feet, model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (nFeet, len(xz), nT), 0.)
+        rows.add(frc)
+        rows.add(p, -1.)
+        rows.add(hip, -1.)
+        rows.addTo(model.footRelativeToCOMDefinition, itertools.product(feet, xz, t))
 
-        def _initialStance(m, foot, region):
-            if self.regions[region]['mu'] == 0.:
-                current_indicator = getattr(m, 'footRegionConstraints[%d,%s,1]indicator_var' % (region, foot))
-                return current_indicator == 0
+        # Hip position
+        #  r_hip == [hip(1), hip(2); hip(2), -hip(1)]*[cth; sth]
+        hipCoefficients = np.zeros((nFeet, len(xz), 2))
+        for i, name in enumerate(feet):
+            hipCoefficients[i, x] = [self.hipOffset[name]['x'], self.hipOffset[name]['z']]
+            hipCoefficients[i, z] = [self.hipOffset[name]['z'], -self.hipOffset[name]['x']]
+        model.hipPositionConstraint = Constraint(model.feet, model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (nFeet, len(xz), nT), 0.)
+        rows.add(hip)
+        rows.add(cth, -hipCoefficients[:, :, 0:1])
+        rows.add(sth, -hipCoefficients[:, :, 1:2])
+        rows.addTo(model.hipPositionConstraint, itertools.product(feet, xz, t))
+
+        model.footVelocityConstraint = Constraint(model.feet, model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (nFeet, len(xz), nT - 1), 0.)
+        rows.add(pd[:, :, 1:])
+        rows.add(pd[:, :, :-1], -1.)
+        rows.addProducts(dt[:-1], pdd[:, :, 1:], -1.)
+        rows.addTo(model.footVelocityConstraint, itertools.product(feet, xz, transitions))
+
+        model.velocityConstraint = Constraint(model.R2_INDEX, model.t)
+        rows = _RowBlock(columns, (len(xz), nT - 1), 0.)
+        rows.add(v[:, 1:])
+        rows.add(v[:, :-1], -1.)
+        rows.addProducts(dt[:-1], F[:, 1:], -1.)
+        rows.addTo(model.velocityConstraint, itertools.product(xz, transitions))
+
+        model.angularVelocityConstraint = Constraint(model.t)
+        rows = _RowBlock(columns, (nT - 1,), 0.)
+        rows.add(w[1:])
+        rows.add(w[:-1], -1.)
+        rows.addProducts(dt[:-1], T[1:], -1./self.momentOfInertia)
+        rows.addTo(model.angularVelocityConstraint, transitions)
+
+        model.orientationConstraint = Constraint(model.t)
+        rows = _RowBlock(columns, (nT - 1,), 0.)
+        rows.add(th[1:])
+        rows.add(th[:-1], -1.)
+        rows.addProducts(dt[:-1], w[1:], -1.)
+        rows.addTo(model.orientationConstraint, transitions)
+
+        # Region constraints, with row (foot, time step, ...) of each block
+        # belonging to disjunct (region, foot, t)
+        terrain = self.terrain()
+        footFamilies = {}
+        bodyFamilies = {}
+        for region in model.REGION_INDEX:
+            A, b = terrain.stacked(region)
+            constraintRows = range(len(b))
+            footFamilies[region] = []
+            rows = _RowBlock(columns, (nFeet, nT, len(b)), b, equality=False)
+            rows.add(foot[:, x, :, np.newaxis], A[:, 0])
+            rows.add(foot[:, z, :, np.newaxis], A[:, 1])
+            footFamilies[region].append(('contactPositionConstraint', (constraintRows,), rows))
+            if terrain.free[region]:
+                # Only used at the interior time steps
+                rows = _RowBlock(columns, (nFeet, nT, len(b), 2), b[:, np.newaxis], equality=False)
+                for side, pm1 in enumerate([-1, 1]):
+                    neighbours = np.clip(np.arange(nT) + pm1, 0, nT - 1)
+                    rows.add(foot[:, x, neighbours, np.newaxis], A[:, 0], rows.rows[..., side])
+                    rows.add(foot[:, z, neighbours, np.newaxis], A[:, 1], rows.rows[..., side])
+                footFamilies[region].append(('footCollisionAvoidanceConstraint', (constraintRows, [-1, 1]), rows))
+                rows = _RowBlock(columns, (nFeet, nT, len(b)), b, equality=False)
+                for j in (x, z):
+                    rows.add(r[j, :, np.newaxis], A[:, j])
+                    rows.add(hip[:, j, :, np.newaxis], A[:, j])
+                footFamilies[region].append(('hipPositionConstraint', (constraintRows,), rows))
+            rows = _RowBlock(columns, (nFeet, nT, len(xz)), 0.)
+            rows.add(f.transpose(0, 2, 1))
+            for bv in range(beta.shape[1]):
+                rows.add(beta[:, bv, :, np.newaxis], -terrain.basisVectors[region, bv, [x, z]])
+            footFamilies[region].append(('contactForceConstraint', (xz,), rows))
+            if not terrain.free[region]:
+                rows = _RowBlock(columns, (nFeet, nT, 1), 0.)
+                rows.add(pd[:, x, :, np.newaxis])
+                footFamilies[region].append(('stationaryFootConstraint', (['x'],), rows))
+
+            if terrain.free[region]:
+                A, b = terrain.inequalities(region)
+                rows = _RowBlock(columns, (nT, len(b)), b - self.bodyRadius, equality=False)
+                rows.add(r[x, :, np.newaxis], A[:, 0])
+                rows.add(r[z, :, np.newaxis], A[:, 1])
+                bodyFamilies[region] = [('bodyPositionConstraint', (range(len(b)),), rows)]
+
+        footConstraints = {}
+        for region, footname, ti in model.FOOT_REGION_INDEX:
+            i, k = feet.index(footname), t.index(ti)
+            footConstraints[region, footname, ti] = [
+                (name, indexSets, _productIndex(indexSets), rows, rows.rows[i, k].ravel())
+                for name, indexSets, rows in footFamilies[region]
+                if name != 'footCollisionAvoidanceConstraint' or 0 < k < nT - 1]
+        bodyConstraints = {}
+        for region, ti in model.BODY_REGION_INDEX:
+            bodyConstraints[region, ti] = [
+                (name, indexSets, _productIndex(indexSets), rows, rows.rows[t.index(ti)])
+                for name, indexSets, rows in bodyFamilies[region]]
+        return footConstraints, bodyConstraints, columns
+
+class _BigM_Transformation(BigM_Transformation):
+    """
+    BigM_Transformation that also handles the constraints indexed by
+    integers and the implicit index sets created inside our disjuncts.
+    The relaxed rows of each constraint are collected in one ConstraintList.
+    """
+
+    alias('hopper.bigm', doc="Big-M relaxation of the hopper disjunctions")
+
+    def __init__(self):
+        super(_BigM_Transformation, self).__init__()
+        self.handlers[Set] = self._xform_skip
+
+    def relaxDisjunct(self, disjunct):
+        # Relaxes one disjunct outside of any Disjunction
+        self._bigM_relax_disjunct(disjunct)
+
+    def _xform_constraint(self, _name, constraint, disjunct):
+        if 'BigM' in disjunct.component_map(Suffix):
+            M = disjunct.component('BigM').get(constraint)
+        else:
+            M = disjunct.next_M()
+        relaxed = ConstraintList()
+        disjunct.add_component('%s_bigM' % _name, relaxed)
+        for index, c in constraint._data.items():
+            if isinstance(M, list):
+                m = M.pop(0) if len(M) else (None, None)
             else:
-                return Constraint.Skip
-
-        model.initialStance = Constraint(model.feet, model.REGION_INDEX, rule=_initialStance)
-
-        def _finalStance(m, foot, region):
-            if self.regions[region]['mu'] == 0.:
-                current_indicator = getattr(m, 'footRegionConstraints[%d,%s,%d]indicator_var' % (region, foot, m.t[-1]))
-                return current_indicator == 0
+                m = M
+            if not c.active:
+                continue
+            c.deactivate()
+            if not isinstance(m, tuple):
+                m = (None, None) if m is None else (-m, m)
+            if (c.lower is not None and m[0] is None) or (c.upper is not None and m[1] is None):
+                m = self._estimate_M(c.body, '%s[%s]' % (_name, index), m, disjunct)
+            for i, bound in enumerate((c.lower, c.upper)):
+                if bound is None:
+                    continue
+                if m[i] is None:
+                    raise GDP_Error('Cannot relax disjunctive constraint %s[%s] because M is not defined.'
+                                    % (_name, index))
+                M_expr = (m[i] - bound)*(1 - disjunct.indicator_var)
+                if i == 0:
+                    relaxed.add(bound <= c.body - M_expr)
+                else:
+                    relaxed.add(c.body - M_expr <= bound)
+
+def _addLogPiecewise(block, index, x, outputs, points):
+    # y[i] == f(x[i]) for every (y, f) in outputs and i in index, linear in
+    # x between the given points. All outputs share one set of convex
+    # combination weights per i, and the segment is selected with
+    # ceil(log2(segments)) binaries through a Gray code (the logarithmic
+    # SOS2 formulation of Vielma and Nemhauser).
+    nSegments = len(points) - 1
+    nBits = int(np.ceil(np.log2(nSegments))) if nSegments > 1 else 0
+    codes = [segment ^ (segment >> 1) for segment in range(nSegments)]
+    # Breakpoint j lies on segments j - 1 and j; it may only carry weight
+    # when a bit equals the value it has on all of them.
+    adjacent = [[codes[segment] for segment in (j - 1, j) if 0 <= segment < nSegments]
+                for j in range(len(points))]
+    ones = [[j for j in range(len(points)) if all(code >> l & 1 for code in adjacent[j])] for l in range(nBits)]
+    zeros = [[j for j in range(len(points)) if not any(code >> l & 1 for code in adjacent[j])] for l in range(nBits)]
+
+    block.POINTS = RangeSet(0, len(points) - 1)
+    block.BITS = Set(initialize=range(nBits), ordered=True)
+    block.OUTPUTS = Set(initialize=range(len(outputs)), ordered=True)
+    block.weights = Var(index, block.POINTS, bounds=(0, 1))
+    block.bits = Var(index, block.BITS, within=Binary)
+
+    def _convexity(b, i):
+        return sum(b.weights[i, j] for j in b.POINTS) == 1
+    block.convexity = Constraint(index, rule=_convexity)
+
+    def _input(b, i):
+        return x[i] == sum(points[j]*b.weights[i, j] for j in b.POINTS)
+    block.input = Constraint(index, rule=_input)
+
+    values = [[float(f(point)) for point in points] for y, f in outputs]
+    def _output(b, k, i):
+        return outputs[k][0][i] == sum(values[k][j]*b.weights[i, j] for j in b.POINTS)
+    block.output = Constraint(block.OUTPUTS, index, rule=_output)
+
+    def _ones(b, i, l):
+        return sum(b.weights[i, j] for j in ones[l]) <= b.bits[i, l]
+    block.ones = Constraint(index, block.BITS, rule=_ones)
+
+    def _zeros(b, i, l):
+        return sum(b.weights[i, j] for j in zeros[l]) <= 1 - b.bits[i, l]
+    block.zeros = Constraint(index, block.BITS, rule=_zeros)
+
+def _plainArray(value):
+    return None if value is None else np.asarray(value, dtype=float).tolist()
+
+def _setValues(variables, values):
+    for var, value in itertools.izip(variables.flat, np.ravel(values)):
+        if not var.fixed and not np.isnan(value):
+            var.value = float(value)
+
+def _varArray(var, *indexSets):
+    shape = tuple(len(s) for s in indexSets)
+    if len(indexSets) == 1:
+        data = [var[i] for i in indexSets[0]]
+    else:
+        data = [var[idx] for idx in itertools.product(*indexSets)]
+    array = np.empty(len(data), dtype=object)
+    array[:] = data
+    return array.reshape(shape)
+
+def _productIndex(indexSets):
+    return list(indexSets[0]) if len(indexSets) == 1 else list(itertools.product(*indexSets))
+
+class _Columns:
+    """
+    Variables of a model numbered as the columns of _RowBlock matrices, with
+    their names (by id) as VarData.cname gives them, without its search for
+    the index.
+    """
+
+    def __init__(self):
+        self.variables = []
+        self.names = {}
+
+    def add(self, var, *indexSets):
+        # Array of the columns of var over the product of the index sets
+        data = _varArray(var, *indexSets)
+        first = len(self.variables)
+        self.variables.extend(data.flat)
+        for variable, index in itertools.izip(data.flat, _productIndex(indexSets)):
+            if isinstance(index, tuple):
+                index = ','.join(str(i) for i in index)
+            self.names[id(variable)] = '%s[%s]' % (var.cname(), index)
+        return np.arange(first, len(self.variables)).reshape(data.shape)
+
+    def name(self, variable):
+        return self.names[id(variable)]
+
+class _RowBlock:
+    """
+    Constraint rows sum_j A[i,j]*x[j] + sum_k P[i,k]*x[j1[k]]*x[j2[k]] == b[i]
+    (or <= b[i]) over the columns x of a _Columns, numbered like the entries
+    of an array of the given shape. Terms are added for arrays of rows at a
+    time and assembled into scipy.sparse matrices on first use.
+    """
+
+    def __init__(self, columns, shape, rhs, equality=True):
+        self.columns = columns
+        self.rows = np.arange(int(np.prod(shape))).reshape(shape)
+        self.rhs = np.ravel(rhs + np.zeros(shape))
+        self.equality = equality
+        empty = np.zeros(0, dtype=int)
+        self._terms = [(empty, empty, np.zeros(0))]
+        self._products = [(empty, empty, empty, np.zeros(0))]
+        self._matrices = None
+
+    def add(self, columns, coefficients=1., rows=None):
+        # Adds coefficients*x[columns] to the rows, all three broadcast
+        # against each other (terms of the same row and column are summed)
+        if rows is None:
+            rows = self.rows
+        self._terms.append(tuple(a.ravel() for a in np.broadcast_arrays(rows, columns, coefficients)))
+        self._matrices = None
+
+    def addProducts(self, first, second, coefficients=1.):
+        self._products.append(tuple(a.ravel() for a in np.broadcast_arrays(self.rows, first, second,
+                                                                            coefficients)))
+        self._matrices = None
+
+    def matrices(self):
+        # (A, P, pairs) with the columns of product k in pairs[:, k]
+        if self._matrices is None:
+            nRows, nColumns = self.rows.size, len(self.columns.variables)
+            rows, columns, coefficients = [np.concatenate(a) for a in zip(*self._terms)]
+            A = scipy.sparse.csr_matrix((coefficients, (rows, columns)), shape=(nRows, nColumns))
+            A.eliminate_zeros()
+            rows, first, second, coefficients = [np.concatenate(a) for a in zip(*self._products)]
+            pairs, products = np.unique(first*nColumns + second, return_inverse=True)
+            P = scipy.sparse.csr_matrix((coefficients, (rows, products)), shape=(nRows, len(pairs)))
+            P.eliminate_zeros()
+            self._matrices = (A, P, np.array(divmod(pairs, nColumns)))
+        return self._matrices
+
+    def body(self, row):
+        # Flat sum of the terms of a row
+        variables = self.columns.variables
+        A, P, pairs = self.matrices()
+        start, end = A.indptr[row], A.indptr[row + 1]
+        args = [variables[j] for j in A.indices[start:end]]
+        coefficients = A.data[start:end].tolist()
+        start, end = P.indptr[row], P.indptr[row + 1]
+        for k, coefficient in itertools.izip(P.indices[start:end], P.data[start:end]):
+            product = EXPR._ProductExpression()
+            product._numerator = [variables[pairs[0, k]], variables[pairs[1, k]]]
+            product._denominator = []
+            product._coef = 1
+            args.append(product)
+            coefficients.append(float(coefficient))
+        return _sumExpression(args, coefficients)
+
+    def addTo(self, constraint, indices, rows=None):
+        # Adds the rows (all of them by default) to an indexed Constraint
+        if rows is None:
+            rows = self.rows.ravel()
+        for index, row in itertools.izip(indices, rows):
+            if self.equality:
+                constraint.add(index, (self.body(row), float(self.rhs[row])))
             else:
-                return Constraint.Skip
-
-        model.finalStance = Constraint(model.feet, model.REGION_INDEX, rule=_finalStance)
-
-        return model
+                constraint.add(index, (None, self.body(row), float(self.rhs[row])))
+
+def _sumExpression(args, coefficients):
+    expression = EXPR._SumExpression()
+    expression._args = args
+    expression._coef = coefficients
+    return expression
+
+def _addArrayDisjunct(disjunct, constraints):
+    for name, indexSets, indices, block, rows in constraints:
+        disjunct.add_component(name, Constraint(*indexSets))
+        block.addTo(disjunct.component(name), indices, rows)
+
+def _blockRows(disjunctName, constraints):
+    # (name, variables, coefficients, lower, upper) of the rows of a disjunct,
+    # from constraints as returned by Hopper._constructArrayConstraints
+    disjunctRows = []
+    for constraintName, _, indices, block, rows in constraints:
+        A = block.matrices()[0]
+        for index, row in itertools.izip(indices, rows):
+            start, end = A.indptr[row], A.indptr[row + 1]
+            rhs = float(block.rhs[row])
+            disjunctRows.append((disjunctName + constraintName + ('.%s' % (index,) if index else ''),
+                                 [block.columns.variables[j] for j in A.indices[start:end]],
+                                 A.data[start:end].tolist(), rhs if block.equality else None, rhs))
+    return disjunctRows
+
+def _disjunctRows(disjunctName, disjunct):
+    # The same for the (linear) constraints of a Disjunct, with the constant
+    # of each body moved into its bounds
+    disjunctRows = []
+    for constraintName, constraint in disjunct.component_map(Constraint).iteritems():
+        for index, c in constraint.iteritems():
+            repn = generate_canonical_repn(c.body)
+            constant = repn.constant or 0
+            disjunctRows.append((disjunctName + constraintName + ('.%s' % (index,) if index else ''),
+                                 list(repn.variables or []), [float(a) for a in repn.linear or []],
+                                 None if c.lower is None else value(c.lower) - constant,
+                                 None if c.upper is None else value(c.upper) - constant))
+    return disjunctRows
+
+def _addHull(model, disjunction, index, name, disjuncts, varName):
+    # Convex hull of one disjunction over the given (name, indicators, rows)
+    # disjuncts, with rows as returned by _blockRows and _disjunctRows and
+    # varName giving the names of their variables. Adds the components (and
+    # names) ConvexHull_Transformation gives a disjunction of Disjuncts: per
+    # disjunct a copy of every variable of the disjunction, bounded by the
+    # indicator, and the disjunct's rows over its copies with their bounds
+    # scaled by the indicator; the variables as the sums of their copies;
+    # and the sum of the indicators as the disjunction. A disjunct without
+    # rows may have several indicators, whose sum then bounds its copies.
+    variables = {}
+    for _, _, rows in disjuncts:
+        for _, args, _, _, _ in rows:
+            variables.update((id(var), var) for var in args)
+    names = dict((key, varName(var)) for key, var in variables.iteritems())
+    copies = dict((key, []) for key in variables)
+
+    for disjunctName, indicators, rows in disjuncts:
+        local = {}
+        for key, var in variables.iteritems():
+            lb, ub = value(var.lb), value(var.ub)
+            copyName = disjunctName + names[key]
+            local[key] = Var(within=var.domain, bounds=(min(0, lb), max(0, ub)))
+            model.add_component(copyName, local[key])
+            copies[key].append(local[key])
+            if lb != 0:
+                model.add_component(copyName + '_lo', Constraint(expr=(
+                    None, _sumExpression(indicators + [local[key]], [lb]*len(indicators) + [-1.]), 0.)))
+            if ub != 0:
+                model.add_component(copyName + '_hi', Constraint(expr=(
+                    None, _sumExpression([local[key]] + indicators, [1.] + [-ub]*len(indicators)), 0.)))
+
+        def _scaledRow(args, coefficients, sign, bound):
+            # sign*(row - bound*indicator)
+            body = _sumExpression([local[id(var)] for var in args], [sign*a for a in coefficients])
+            if bound != 0:
+                body._args.append(indicators[0])
+                body._coef.append(-sign*bound)
+            return body
+
+        for rowName, args, coefficients, lower, upper in rows:
+            if lower is not None:
+                if lower != 0:
+                    expr = (None, _scaledRow(args, coefficients, -1., lower), 0.)
+                else:
+                    expr = (0., _scaledRow(args, coefficients, 1., 0.), None)
+                model.add_component(rowName + '_lo', Constraint(expr=expr))
+            if upper is not None:
+                model.add_component(rowName + '_hi', Constraint(expr=(
+                    None, _scaledRow(args, coefficients, 1., upper), 0.)))
+
+    for key, var in sorted(variables.iteritems(), key=lambda item: names[item[0]]):
+        # Pyomo turns var == var (a single disjunct) into copy - var == 0
+        if len(copies[key]) == 1:
+            body = _sumExpression([copies[key][0], var], [1., -1.])
+        else:
+            body = _sumExpression([var] + copies[key], [1.] + [-1.]*len(copies[key]))
+        model.add_component('%s.%s' % (name, names[key]), Constraint(expr=(body, 0.)))
+    indicators = [indicator for _, disjunctIndicators, _ in disjuncts for indicator in disjunctIndicators]
+    disjunction.add(index, (_sumExpression(indicators, [1.]*len(indicators)), 1.))
 
 #def testHopper(hopper, r0, rf, legLength):
     #hopper.constructPyomoModel()
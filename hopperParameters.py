@@ -0,0 +1,40 @@
+from __future__ import division
+
+
+class HopperParameters:
+    """
+    Pure-Python replacement for the robot parameters that Hopper otherwise
+    fetches from the MATLAB Hopper object.
+
+    hipInBody gives the hip positions (in meters) in the body frame, keyed by
+    foot name ('front' and 'back' for LittleDog). The hip offsets are
+    returned in leg lengths, as Hopper.m/constructHipInBody does.
+    momentOfInertia is the dimensionless moment of inertia I/(m*legLength^2)
+    that Hopper.m/getDimensionlessMomentOfInertia computes from LittleDog's
+    centroidal inertia; see boxMomentOfInertia for robots without a model.
+    """
+
+    def __init__(self, legLength, hipInBody, momentOfInertia):
+        self.legLength = legLength
+        self.hipInBody = hipInBody
+        self.momentOfInertia = momentOfInertia
+
+    def getHipInBody(self):
+        return dict((foot, {'x': hip['x']/self.legLength, 'z': hip['z']/self.legLength})
+                    for foot, hip in self.hipInBody.iteritems())
+
+    def getDimensionlessMomentOfInertia(self):
+        return self.momentOfInertia
+
+def boxMomentOfInertia(legLength, hipInBody, legMassFraction=0.):
+    # Dimensionless moment of inertia of a uniform box spanning the hips,
+    # optionally with part of the mass lumped at the hips for the legs. Only
+    # an approximation of the centroidal inertia of a real robot.
+    x = [hip['x'] for hip in hipInBody.itervalues()]
+    z = [hip['z'] for hip in hipInBody.itervalues()]
+    bodyLength = max(x) - min(x)
+    bodyHeight = 2*max(abs(zi) for zi in z)
+    I_body = (bodyLength**2 + bodyHeight**2)/12
+    I_legs = sum(xi**2 + zi**2 for xi, zi in zip(x, z))/len(x)
+    I = (1 - legMassFraction)*I_body + legMassFraction*I_legs
+    return I/legLength**2
@@ -1,44 +1,163 @@
 from __future__ import division
+import time
 import numpy as np
+from collections import OrderedDict
+from pyomo.environ import *
 from pyomo.opt import SolverFactory
+from pyomo.core.base.expr import identify_variables
 from pyomo.core.plugins.transform.radix_linearization import *
 from mccormick_envelope import *
+from telemetry import nullTelemetry
+from costTerms import CostTerms
+import persistentSolver
 from pyomo.core.base.component import register_component, Component, ComponentUID
 
 
-def constructRelaxedModel(m_nlp, dt=None):
-    m = m_nlp.clone()
-    if dt is not None:
-        m.dt.fix(dt)
-    else:
-        m.dt.fix()
-    mccormick = McCormickEnvelope()
-    m = mccormick.create_using(m, verbose=True)
+def constructRelaxedModel(m_nlp, dt=None, telemetry=nullTelemetry, **kwargs):
+    # kwargs (partitions, partitionWidth, encoding, discretize) are passed on
+    # to McCormickEnvelope
+    with telemetry.stage('constructRelaxedModel'):
+        m = m_nlp.clone()
+        if dt is not None:
+            m.dt.fix(dt)
+        else:
+            m.dt.fix()
+        mccormick = McCormickEnvelope()
+        m = mccormick.create_using(m, verbose=True, **kwargs)
+    telemetry.count('constructRelaxedModel', m)
     return m
 
-def constructMDTModel(m_nlp, desiredPrecision, dt=None):
-    m = m_nlp.clone()
-    if dt is not None:
-        m.dt.fix(dt)
-    else:
-        m.dt.fix()
-    RadixLinearization.radix = 2
-    mdt = RadixLinearization()
-    #discretizationVar = m.footRelativeToCOM
-    discretizationVar = m.f
-    fBounds = m.f.values()[0].bounds
-    print fBounds
-    footBounds = m.footRelativeToCOM.values()[0].bounds
-    print footBounds
-    maxVal = (fBounds[1] - fBounds[0])*(footBounds[1] - footBounds[0])
-    precision = 1+0*int(np.ceil(-np.log2(desiredPrecision/maxVal)))
-    print 'MDT precision: %d' % precision
-    m = mdt.create_using(m, verbose=True, precision=desiredPrecision, discretize=[discretizationVar])
-
-    for z_data in m.z.values():
-        z_data._component().branchPriority = 1
+def bilinearResidual(m):
+    # Largest |w - u*v| over the McCormick terms of a relaxed model.
+    return max(list(bilinearResiduals(m)) or [0.])
+
+def _bilinearProducts(m):
+    # (expression, u, v) for every product of two unfixed variables in the
+    # active degree-two constraints of m.
+    products = []
+    quadratic = []
+    radix = RadixLinearization()
+    for c in m.component_data_objects(Constraint, active=True):
+        if c.body.polynomial_degree() == 2:
+            radix._collect_bilinear(c.body, products, quadratic)
+    return [(expr, u, v) for expr, u, v in products if not (u.fixed or v.fixed)]
+
+def bilinearTerms(m):
+    # (u, v) pairs of the distinct bilinear products in the active
+    # constraints of m.
+    pairs = OrderedDict()
+    for _, u, v in _bilinearProducts(m):
+        pairs.setdefault(frozenset((id(u), id(v))), (u, v))
+    return pairs.values()
+
+def mdtDiscretization(terms):
+    # Greedy cover of the bilinear terms: repeatedly discretize the
+    # variable shared by the most uncovered terms, preferring the narrower
+    # domain on ties.
+    termIds = [set(id(var) for var in term) for term in terms]
+    uncovered = set(range(len(terms)))
+    variables = OrderedDict((id(var), var) for term in terms for var in term)
+    discretize = []
+    while uncovered:
+        def _score(var):
+            count = sum(1 for i in uncovered if id(var) in termIds[i])
+            return count, -(var.ub - var.lb)
+        var = max(variables.itervalues(), key=_score)
+        discretize.append(var)
+        uncovered = set(i for i in uncovered if id(var) not in termIds[i])
+        del variables[id(var)]
+    return discretize
+
+def mdtPrecision(terms, accuracy, maxPrecision=12):
+    # Number of radix-2 digits for which the MDT error bound
+    # (u_ub - u_lb)*(v_ub - v_lb)*2^-p/4 is below accuracy for every term.
+    widest = max((u.ub - u.lb)*(v.ub - v.lb) for u, v in terms)
+    return int(min(maxPrecision, max(1, np.ceil(np.log2(widest/(4*accuracy))))))
+
+def constructMDTModel(m_nlp, accuracy, dt=None, maxPrecision=12, verbose=False, telemetry=nullTelemetry):
+    with telemetry.stage('constructMDTModel'):
+        m = m_nlp.clone()
+        if dt is not None:
+            m.dt.fix(dt)
+        else:
+            m.dt.fix()
+        terms = bilinearTerms(m)
+        discretize = mdtDiscretization(terms)
+        precision = mdtPrecision(terms, accuracy, maxPrecision)
+        if verbose:
+            print 'MDT precision: %d, discretizing %d variables' % (precision, len(discretize))
+        # RadixLinearization's own discretize option is broken in this Pyomo
+        # version, so its steps are applied here with our choice of variables.
+        mdt = RadixLinearization()
+        m.DISCRETIZATION = RangeSet(precision)
+        m.DISCRETIZED_VARIABLES = RangeSet(0, len(discretize) - 1)
+        m.z = Var(m.DISCRETIZED_VARIABLES, m.DISCRETIZATION, within=Binary)
+        m.dv = Var(m.DISCRETIZED_VARIABLES, bounds=(0, 2**-precision))
+        indices = OrderedDict()
+        for var in discretize:
+            indices[id(var)] = len(indices)
+            mdt._discretize_variable(m, var, indices[id(var)])
+        known = {}
+        for expr, u, v in _bilinearProducts(m):
+            mdt._discretize_term(expr, u, v, m, indices, known)
+
+        # Branch on the most significant digits of the earliest time steps
+        # first.
+        m.priority = Suffix(direction=Suffix.EXPORT, datatype=Suffix.INT)
+        for i, var in enumerate(discretize):
+            for k in m.DISCRETIZATION:
+                m.priority[m.z[i, k]] = (len(m.t) - var.index()[-1] + 1)*precision + precision - k + 1
+    telemetry.count('constructMDTModel', m)
     return m
 
+def torqueBalanceResidual(m):
+    # Largest violation of the true moment balance about the COM, using the
+    # variable values of a (relaxed) hopper model.
+    return max(abs(value(m.T[t]) + sum(value(m.footRelativeToCOM[foot, 'x', t])*value(m.f[foot, 'z', t]) -
+                                       value(m.footRelativeToCOM[foot, 'z', t])*value(m.f[foot, 'x', t])
+                                       for foot in m.feet))
+               for t in m.t)
+
+def bilinearResiduals(m):
+    return np.array([abs(value(w) - value(u)*value(v)) for w, u, v in m.mccormickTerms])
+
+def refineRelaxation(m, opt, tol=1e-3, maxIterations=10, timeLimit=None, factor=2, maxPartitions=64,
+                     verbose=False, **solveOptions):
+    # Solves the relaxed model m, doubles (factor) the McCormick partitions
+    # of only the terms whose |w - u*v| exceeds tol and re-solves from the
+    # previous incumbent, until every residual is below tol, no term can be
+    # refined further, or timeLimit [s] is used up. Returns one record per
+    # iteration.
+    mccormick = McCormickEnvelope()
+    history = []
+    start = time.time()
+    for iteration in range(maxIterations):
+        t0 = time.time()
+        results = solveModel(m, opt, warmstart=(iteration > 0), **solveOptions)
+        solveTime = time.time() - t0
+        record = {'iteration': iteration, 'solveTime': solveTime, 'refineTime': 0., 'nRefined': 0,
+                  'status': str(results.solver.termination_condition), 'maxResidual': None}
+        history.append(record)
+        if len(results.solution) == 0:
+            break
+        residuals = bilinearResiduals(m)
+        record['maxResidual'] = residuals.max() if len(residuals) else 0.
+        refine = [i for i in np.flatnonzero(residuals > tol) if m.mccormickPartitions[i]*factor <= maxPartitions]
+        if verbose:
+            print 'Refinement %d: max residual %g, %d terms above %g, solve %.2f s' % (
+                iteration, record['maxResidual'], np.count_nonzero(residuals > tol), tol, solveTime)
+        if not refine or (timeLimit is not None and time.time() - start >= timeLimit):
+            break
+
+        t0 = time.time()
+        mccormick.refine(m, refine, factor)
+        for i in refine:
+            w, u, v = m.mccormickTerms[i]
+            w.value = value(u)*value(v)
+        record['refineTime'] = time.time() - t0
+        record['nRefined'] = len(refine)
+    return history
+
 def constructCouenneSolver(**kwargs):
     opt = SolverFactory('couenne')
     return opt
@@ -51,8 +170,26 @@ def constructMinotaurSolver():
     # opt.set_options('--linfpump=1')
     return opt
 
-def constructGurobiSolver(**kwargs):
-    opt = SolverFactory('_gurobi_direct')
+def solveModel(m, opt, telemetry=nullTelemetry, **solveOptions):
+    # opt.solve, with the solution (if any) loaded into m by us: with
+    # load_solutions=True the solver clears results.solution after loading.
+    # The solve and the loading are separate stages. The solver's own run
+    # time is recorded with the solve, so the rest of that stage is problem
+    # write-out and result parsing.
+    with telemetry.stage('solve') as stage:
+        results = opt.solve(m, load_solutions=False, **solveOptions)
+        solverTime = results.solver.wallclock_time
+        if isinstance(solverTime, (int, float)):
+            stage.extra['solverTime'] = solverTime
+    with telemetry.stage('load'):
+        if len(results.solution) > 0:
+            m.solutions.load_from(results)
+    return results
+
+def constructGurobiSolver(persistent=False, **kwargs):
+    # persistent keeps the Gurobi model between solves, see
+    # persistentSolver.PersistentSolver
+    opt = SolverFactory('hopper.gurobi_persistent' if persistent else '_gurobi_direct')
     for key, value in kwargs.iteritems():
         opt.set_options('%s=%f' % (key, value))
     return opt
@@ -75,6 +212,163 @@ def unfixIntegerVariables(m):
             #print 'Fixing %s to %s' % (ComponentUID(var), var.value)
             var.fixed = False
 
+def modelSize(m):
+    # Number of (unfixed) variables appearing in active constraints and
+    # number of active constraints, which is what the solver sees.
+    variables = set()
+    nConstraints = 0
+    for c in m.component_data_objects(Constraint, active=True):
+        nConstraints += 1
+        for var in identify_variables(c.body, include_fixed=False):
+            variables.add(id(var))
+    return len(variables), nConstraints
+
+def constraintResiduals(c):
+    lower = None if c.lower is None else value(c.body) - value(c.lower)
+    upper = None if c.upper is None else value(c.body) - value(c.upper)
+    return lower, upper
+
+def maxConstraintViolation(m):
+    violation = 0.
+    for c in m.component_data_objects(Constraint, active=True):
+        lower, upper = constraintResiduals(c)
+        violation = max(violation, 0. if lower is None else -lower, 0. if upper is None else upper)
+    return violation
+
+def copyValues(source, target):
+    # Sets the unfixed variables of target to the values of the variables of
+    # source with the same names, e.g. to evaluate the solution of a relaxed
+    # model on the model it was built from.
+    sourceVars = dict((var.cname(True), var) for var in source.component_objects(Var))
+    for var in target.component_objects(Var):
+        sourceVar = sourceVars.get(var.cname(True))
+        if sourceVar is None:
+            continue
+        for index, data in var.iteritems():
+            if not data.fixed:
+                data.value = sourceVar[index].value
+
+def compareModels(m_a, m_b, nSamples=3, tol=1e-8, seed=0):
+    # Evaluates the active constraints of both models at shared random
+    # points (overwriting the values of unfixed variables) and returns the
+    # names of components that are missing from one model or disagree.
+    vars_a = dict((var.cname(True), var) for var in m_a.component_data_objects(Var))
+    vars_b = dict((var.cname(True), var) for var in m_b.component_data_objects(Var))
+    cons_a = dict((c.cname(True), c) for c in m_a.component_data_objects(Constraint, active=True))
+    cons_b = dict((c.cname(True), c) for c in m_b.component_data_objects(Constraint, active=True))
+    mismatches = sorted(set(vars_a) ^ set(vars_b)) + sorted(set(cons_a) ^ set(cons_b))
+    all_vars = sorted(set(vars_a) | set(vars_b))
+    shared_cons = sorted(set(cons_a) & set(cons_b))
+    rng = np.random.RandomState(seed)
+    for sample in range(nSamples):
+        for name in all_vars:
+            var = vars_a.get(name, vars_b.get(name))
+            lb, ub = var.bounds
+            val = rng.uniform(-1. if lb is None else lb, 1. if ub is None else ub)
+            for vars_ in (vars_a, vars_b):
+                if name in vars_ and not vars_[name].fixed:
+                    vars_[name].value = val
+        for name in shared_cons:
+            for res_a, res_b in zip(constraintResiduals(cons_a[name]), constraintResiduals(cons_b[name])):
+                if (res_a is None) != (res_b is None) or \
+                        (res_a is not None and abs(res_a - res_b) > tol*max(1., abs(res_a))):
+                    mismatches.append(name)
+                    break
+    return sorted(set(mismatches))
+
+def normL2(m, var):
+    return CostTerms(m).l2(var)
+
+def normL1(m, var):
+    return CostTerms(m).l1(var)
+
+def normLInfinity(m, var):
+    return CostTerms(m).lInfinity(var)
+
+def footRegionChanges(m, hop):
+    return CostTerms(m).regionChanges(hop)
+
+def addHopperObjective(m, hop, norm=normL2, regionChangeWeight=1e1):
+    # Returns the CostTerms of the objective
+    with hop.telemetry.stage('objective'):
+        costs = CostTerms(m)
+        costs.regionChanges(hop, regionChangeWeight)
+        for var in (m.pdd, m.beta, m.hipTorque):
+            costs.add(var.cname(), norm(m, var))
+        costs.addObjective()
+    return costs
+
+def addBoundaryConditions(m, r0, rf, legLength, verticalVelocityMax=0.5):
+    m.rx0 = Constraint(expr=m.r['x',m.t[1]] == r0[0]/legLength)
+    m.th0 = Constraint(expr=m.th[m.t[1]] == 0)
+    m.vx0 = Constraint(expr=m.v['x',m.t[1]] == 0)
+    m.vz0 = Constraint(expr=m.v['z',m.t[1]] == 0)
+    m.w0 = Constraint(expr=m.w[m.t[1]] == 0)
+    m.Fx0 = Constraint(expr=m.F['x', m.t[1]] == 0)
+    m.Fz0 = Constraint(expr=m.F['z', m.t[1]] == 0)
+    m.T0 = Constraint(expr=m.T[m.t[1]] == 0)
+
+    m.rxf = Constraint(expr=m.r['x',m.t[-1]] >= rf[0]/legLength)
+    m.thf = Constraint(expr=m.th[m.t[-1]] == 0)
+    m.vxf = Constraint(expr=m.v['x',m.t[-1]] == m.v['x',m.t[1]])
+    m.vzf = Constraint(expr=m.v['z',m.t[-1]] == 0)
+    m.wf = Constraint(expr=m.w[m.t[-1]] == 0)
+    m.Fxf = Constraint(expr=m.F['x', m.t[-1]] == 0)
+    m.Fzf = Constraint(expr=m.F['z', m.t[-1]] == 0)
+    m.Tf = Constraint(expr=m.T[m.t[-1]] == 0)
+
+    def _maxVerticalVelocityRule(m, t):
+        return m.v['z', t] <= verticalVelocityMax
+    m.maxVerticalVelocityConstraint = Constraint(m.t, rule=_maxVerticalVelocityRule)
+
+def addMutableBoundaryConditions(m, verticalVelocityMax=0.5):
+    # Same terminal conditions as addBoundaryConditions, but the initial
+    # state (r, v, th, w) and the final x lower bound are mutable Params
+    # (in leg lengths), so they can be changed without rebuilding the model.
+    m.initialPosition = Param(m.R2_INDEX, mutable=True, initialize=0.)
+    m.initialVelocity = Param(m.R2_INDEX, mutable=True, initialize=0.)
+    m.initialOrientation = Param(mutable=True, initialize=0.)
+    m.initialAngularVelocity = Param(mutable=True, initialize=0.)
+    m.finalPositionMin = Param(mutable=True, initialize=0.)
+
+    def _r0Rule(m, xz):
+        return m.r[xz, m.t[1]] == m.initialPosition[xz]
+    m.r0 = Constraint(m.R2_INDEX, rule=_r0Rule)
+
+    def _v0Rule(m, xz):
+        return m.v[xz, m.t[1]] == m.initialVelocity[xz]
+    m.v0 = Constraint(m.R2_INDEX, rule=_v0Rule)
+    m.th0 = Constraint(expr=m.th[m.t[1]] == m.initialOrientation)
+    m.w0 = Constraint(expr=m.w[m.t[1]] == m.initialAngularVelocity)
+
+    m.rxf = Constraint(expr=m.r['x',m.t[-1]] >= m.finalPositionMin)
+    m.thf = Constraint(expr=m.th[m.t[-1]] == 0)
+    m.vxf = Constraint(expr=m.v['x',m.t[-1]] == m.v['x',m.t[1]])
+    m.vzf = Constraint(expr=m.v['z',m.t[-1]] == 0)
+    m.wf = Constraint(expr=m.w[m.t[-1]] == 0)
+    m.Fxf = Constraint(expr=m.F['x', m.t[-1]] == 0)
+    m.Fzf = Constraint(expr=m.F['z', m.t[-1]] == 0)
+    m.Tf = Constraint(expr=m.T[m.t[-1]] == 0)
+
+    def _maxVerticalVelocityRule(m, t):
+        return m.v['z', t] <= verticalVelocityMax
+    m.maxVerticalVelocityConstraint = Constraint(m.t, rule=_maxVerticalVelocityRule)
+
+def addTrigConstraints(m):
+    # Replaces the piecewise-linear cos/sin of the orientation with the exact
+    # functions, for NLP solves.
+    for name in ['pwSin', 'pwCos', 'pwTrig']:
+        if m.component(name) is not None:
+            m.component(name).deactivate()
+
+    def _cos(m, t):
+        return m.cth[t] == cos(m.th[t])
+    m.Cos = Constraint(m.t, rule=_cos)
+
+    def _sin(m, t):
+        return m.sth[t] == sin(m.th[t])
+    m.Sin = Constraint(m.t, rule=_sin)
+
 def addThreePlatfomWorld(hop, legLength, step_height):
     step_length = 2.0*legLength
     gap_length = 0.65*step_length
@@ -94,8 +388,27 @@ def addThreePlatfomWorld(hop, legLength, step_height):
     hop.addFreeBlock(bottom=platform2_height/legLength, left=platform1_end/legLength, right=platform3_start/legLength)
     hop.addFreeBlock(bottom=platform3_height/legLength, left=platform2_end/legLength)
 
+def addStaircaseWorld(hop, legLength, step_height, nSteps, flatSteps=1):
+    # addThreePlatfomWorld continued for nSteps platforms, the first
+    # flatSteps of them on the ground under one free block, giving
+    # 2*nSteps - flatSteps + 1 regions. The hopper may already have
+    # platforms of its own.
+    step_length = 2.0*legLength
+    gap_length = 0.65*step_length
+    first = len(hop.platforms)
+    for i in range(nSteps):
+        platform_start = -1*legLength + i*(step_length + gap_length)
+        height = max(0, i - flatSteps + 1)*step_height
+        hop.addPlatform(platform_start/legLength, (platform_start + step_length)/legLength, height/legLength,
+                        1, 0.5*4.78*step_length, -0.5*4.78*step_length)
+    platforms = hop.platforms[first:]
+    for i in range(flatSteps - 1, nSteps):
+        left = platforms[i-1][1] if i >= flatSteps else None
+        right = platforms[i+1][0] if i < nSteps - 1 else None
+        hop.addFreeBlock(bottom=platforms[i][2], left=left, right=right)
+
 def addFlatWorld(hop, legLength):
-    hop.addPlatform(-1./legLength, 10./legLength, 0., 1)
+    hop.addPlatform(-1./legLength, 10./legLength, 0., 1, 0.5*4.78*2.0*legLength, -0.5*4.78*2.0*legLength)
     hop.addFreeBlock(bottom=0.)
 
 
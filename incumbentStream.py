@@ -0,0 +1,136 @@
+from __future__ import division
+import os
+import time
+import numpy as np
+
+from persistentSolver import _GurobiPersistent
+
+
+def _gap(objective, bound):
+    return abs(objective - bound)/max(abs(objective), 1e-10)
+
+def incumbentDtype(solutionDtype, N):
+    # One incumbent: its number, objective, best bound and elapsed solver
+    # time at the moment it was found, and its extractSolution() array.
+    return np.dtype([('index', int),
+                     ('objective', float),
+                     ('bound', float),
+                     ('time', float),
+                     ('solution', solutionDtype, (N,))])
+
+
+class IncumbentLog:
+    """
+    Append-only file of incumbents. All records have the same size, so each
+    incumbent is one write, and readIncumbents can memory-map the records
+    written so far while the solve is still running. The record dtype is
+    kept in a <filename>.dtype.npy sidecar. A log replaces any earlier log
+    of the same name on its first record.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.dtype = None
+        self._file = None
+
+    def _open(self, solution):
+        # The old records go before the dtype changes
+        self.dtype = incumbentDtype(solution.dtype, len(solution))
+        self._file = open(self.filename, 'wb')
+        np.save(self.filename + '.dtype.npy', np.zeros(0, dtype=self.dtype))
+
+    def append(self, record):
+        if self._file is None:
+            self._open(record['solution'])
+        entry = np.zeros(1, dtype=self.dtype)
+        for field in self.dtype.names:
+            entry[field] = record[field]
+        self._file.write(entry.tostring())
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def readIncumbents(filename, start=0):
+    # Memory-mapped records of an IncumbentLog from the start-th on. A record
+    # that is only partly written is left out.
+    dtypeFilename = filename + '.dtype.npy'
+    if not os.path.exists(dtypeFilename):
+        return None
+    dtype = np.load(dtypeFilename).dtype
+    count = os.path.getsize(filename)//dtype.itemsize - start
+    if count <= 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode='r', offset=start*dtype.itemsize, shape=(count,))
+
+def followIncumbents(filename, poll=1., timeout=None):
+    # Yields the records of an IncumbentLog as they are appended, e.g. to
+    # polish the first good incumbents in another process while the MIP
+    # solve goes on. Stops after timeout seconds without a new record.
+    start = 0
+    lastRecord = time.time()
+    while timeout is None or time.time() - lastRecord < timeout:
+        records = readIncumbents(filename, start)
+        if records is not None and len(records) > 0:
+            for record in records:
+                yield record
+            start += len(records)
+            lastRecord = time.time()
+        else:
+            time.sleep(poll)
+
+def gapReached(targetGap):
+    # Early-abort policy: stops the solve once an incumbent is within
+    # targetGap of the best bound.
+    return lambda record: record['gap'] <= targetGap
+
+
+class IncumbentStream:
+    """
+    Receives the incumbents of a MIP solve of a hopper model while the
+    solver is still running. Each one is extracted into an extractSolution()
+    array and, with its objective, bound and elapsed time, appended to the
+    IncumbentLog (when there is one) and passed to every subscriber.
+    Subscribers (the visualizer, an early-abort policy like gapReached, ...)
+    are called with the record dict and stop the solve by returning True.
+    """
+
+    def __init__(self, hop, m, log=None, subscribers=()):
+        self.hop = hop
+        self.m = m
+        self.log = log
+        self.subscribers = list(subscribers)
+        self.count = 0
+        self.variables = [var for field, array in hop._solutionVariables(m).iteritems()
+                          if field != 'body_regions' for var in array.flat]
+
+    def subscribe(self, subscriber):
+        self.subscribers.append(subscriber)
+
+    def __call__(self, objective, bound, elapsed):
+        record = {'index': self.count, 'objective': objective, 'bound': bound, 'gap': _gap(objective, bound),
+                  'time': elapsed, 'solution': self.hop.extractSolution(self.m)}
+        self.count += 1
+        if self.log is not None:
+            self.log.append(record)
+        stop = False
+        for subscriber in self.subscribers:
+            stop = bool(subscriber(record)) or stop
+        return stop
+
+
+def solveStreaming(m, opt, stream, **solveOptions):
+    # opt.solve(m) with every incumbent passed to stream; opt is a
+    # 'hopper.gurobi_persistent' solver, e.g. constructGurobiSolver(persistent=True).
+    if not isinstance(opt, _GurobiPersistent):
+        raise ValueError('Streaming incumbents needs the hopper.gurobi_persistent solver')
+    opt.incumbentCallback = stream
+    try:
+        return opt.solve(m, **solveOptions)
+    finally:
+        opt.incumbentCallback = None
+        if stream.log is not None:
+            stream.log.close()
@@ -15,6 +15,8 @@ from pyomo.core.base.expr import _ProductExpression, _PowExpression
 from pyomo.core.base.var import _VarData
 
 from scipy.constants import golden
+import math
+from collections import OrderedDict
 
 from six import iteritems
 
@@ -25,6 +27,12 @@ logger = logging.getLogger(__name__)
 class McCormickEnvelope(Transformation):
     """
     This plugin generates linear relaxations of bilinear problems using McCormick envelopes.
+
+    With partitions > 1 (an int, a dict from Var name to int, or derived from
+    partitionWidth) the domain of one factor of each term is split into
+    equal intervals chosen by binaries ('linear' or 'log' encoding), and the
+    envelope of the selected interval is enforced. The partitioned factor is
+    the one whose Var is listed in discretize, otherwise the first factor.
     """
 
     alias("core.mccormick_envelope",
@@ -33,8 +41,17 @@ class McCormickEnvelope(Transformation):
     radix = 2
     def _create_using(self, model, **kwds):
         verbose = kwds.pop('verbose',False)
+        self._partitions = kwds.pop('partitions', 1)
+        self._partitionWidth = kwds.pop('partitionWidth', None)
+        self._encoding = kwds.pop('encoding', 'linear')
+        self._discretize = set(v.cname(True) for v in kwds.pop('discretize', []))
+        if self._encoding not in ('linear', 'log'):
+            raise ValueError("Unknown partition encoding '%s'" % self._encoding)
 
         M = model.clone()
+        M.mccormickTerms = []
+        M.mccormickPartitions = []
+        M.mccormickEncoding = self._encoding
 
         # Iterate over all Constraints and identify the bilinear and
         # quadratic terms
@@ -59,7 +76,7 @@ class McCormickEnvelope(Transformation):
         else:
             _block = M
 
-        _known_bilinear = {}
+        _known_bilinear = OrderedDict()
         # For each quadratic term, if it hasn't been discretized /
         # generated, do so, and remember the resulting W term for later
         # use...
@@ -73,6 +90,8 @@ class McCormickEnvelope(Transformation):
             self._relax_term(_expr, _x1, _x2, _block, _known_bilinear)
         for _expr, _x1 in quadratic_terms:
             self._relax_term(_expr, _x1, _x1, _block, _known_bilinear)
+        M.mccormickTerms = [term for term in _known_bilinear.itervalues()]
+        M.mccormickPartitions = [self._partition_count(u) for w, u, v in M.mccormickTerms]
 
         # Return the relaxed instance!
         return M
@@ -80,10 +99,21 @@ class McCormickEnvelope(Transformation):
     def _relax_term(self, _expr, _u, _v, _block, _known_bilinear):
         _id = (id(_v), id(_u))
         if _id not in _known_bilinear:
-            _known_bilinear[_id] = self._relax_bilinear(_block, _u, _v)
+            if _v.parent_component().cname(True) in self._discretize and \
+                    _u.parent_component().cname(True) not in self._discretize:
+                _u, _v = _v, _u
+            _known_bilinear[_id] = (self._relax_bilinear(_block, _u, _v), _u, _v)
         # _expr should be a "simple" product expression; substitute
         # in the bilinear "W" term for the raw bilinear terms
-        _expr._numerator = [ _known_bilinear[_id] ]
+        _expr._numerator = [ _known_bilinear[_id][0] ]
+
+    def _partition_count(self, u):
+        if self._partitionWidth is not None:
+            u_lb, u_ub = u.bounds
+            return max(1, int(math.ceil((u_ub - u_lb)/float(self._partitionWidth) - 1e-9)))
+        if isinstance(self._partitions, dict):
+            return self._partitions.get(u.parent_component().cname(True), 1)
+        return self._partitions
 
 
     def _relax_bilinear(self, b, u, v):
@@ -99,15 +129,81 @@ class McCormickEnvelope(Transformation):
                          max(u_lb*v_lb, u_lb*v_ub, u_ub*v_lb, u_ub*v_ub)))
         b.add_component("w_%s_%s" % (u.cname(), v.cname()), w)
 
+        self._add_envelope(b, w, u, v, self._partition_count(u), self._encoding)
+        return w
+
+    def refine(self, M, terms, factor=2):
+        """
+        Rebuilds the envelopes of the given terms (indices into
+        M.mccormickTerms) with factor times as many partitions, in place.
+        The new binaries are set from the current values of u and v.
+        """
+        for i in terms:
+            w, u, v = M.mccormickTerms[i]
+            K = M.mccormickPartitions[i]*factor
+            b = w.parent_block()
+            for prefix in ('c_mccormick', 'y', 's'):
+                name = "%s_%s_%s" % (prefix, u.cname(), v.cname())
+                for component in (name, name + '_index'):
+                    if b.component(component) is not None:
+                        b.del_component(component)
+            self._add_envelope(b, w, u, v, K, M.mccormickEncoding)
+            M.mccormickPartitions[i] = K
+
+    def _add_envelope(self, b, w, u, v, K, encoding):
+        u_lb, u_ub = u.bounds
+        v_lb, v_ub = v.bounds
         _c = ConstraintList(noruleinit=True)
         b.add_component( "c_mccormick_%s_%s" % (u.cname(), v.cname()), _c )
 
-        _c.add(expr=w >= u * v_lb + u_lb * v - u_lb*v_lb)
-        _c.add(expr=w >= u * v_ub + u_ub * v - u_ub*v_ub)
-        _c.add(expr=w <= u * v_lb + u_ub * v - u_ub*v_lb)
-        _c.add(expr=w <= u * v_ub + u_lb * v - u_lb*v_ub)
+        if K <= 1:
+            _c.add(expr=w >= u * v_lb + u_lb * v - u_lb*v_lb)
+            _c.add(expr=w >= u * v_ub + u_ub * v - u_ub*v_ub)
+            _c.add(expr=w <= u * v_lb + u_ub * v - u_ub*v_lb)
+            _c.add(expr=w <= u * v_ub + u_lb * v - u_lb*v_ub)
+            return
 
-        return w
+        # The selected interval is [a, a + delta] with a = u_lb + delta*n,
+        # n = sum_j c_j*y_j for binaries y. The products y_j*v are
+        # linearized exactly through s_j.
+        delta = (u_ub - u_lb)/float(K)
+        if encoding == 'log':
+            c = [2**j for j in range(int(math.ceil(math.log(K, 2))))]
+        else:
+            c = range(K)
+        bits = range(len(c))
+        y = Var(bits, within=Binary)
+        b.add_component("y_%s_%s" % (u.cname(), v.cname()), y)
+        s = Var(bits, bounds=(min(v_lb, 0), max(v_ub, 0)))
+        b.add_component("s_%s_%s" % (u.cname(), v.cname()), s)
+        for j in bits:
+            _c.add(expr=s[j] >= v_lb*y[j])
+            _c.add(expr=s[j] <= v_ub*y[j])
+            _c.add(expr=s[j] >= v - v_ub*(1 - y[j]))
+            _c.add(expr=s[j] <= v - v_lb*(1 - y[j]))
+        if encoding == 'log':
+            _c.add(expr=sum(c[j]*y[j] for j in bits) <= K - 1)
+        else:
+            _c.add(expr=sum(y[j] for j in bits) == 1)
+
+        # Expressions are built afresh for every constraint, as Pyomo may
+        # modify sums in place.
+        def a():
+            return u_lb + delta*sum(c[j]*y[j] for j in bits)
+        def av():
+            return u_lb*v + delta*sum(c[j]*s[j] for j in bits)
+        _c.add(expr=u >= a())
+        _c.add(expr=u <= a() + delta)
+        _c.add(expr=w >= u * v_lb + av() - v_lb*a())
+        _c.add(expr=w >= u * v_ub + av() + delta*v - v_ub*(a() + delta))
+        _c.add(expr=w <= u * v_lb + av() + delta*v - v_lb*(a() + delta))
+        _c.add(expr=w <= u * v_ub + av() - v_ub*a())
+
+        if u.value is not None and v.value is not None:
+            n = min(max(int((u.value - u_lb)/delta), 0), K - 1)
+            for j in bits:
+                y[j].value = float((n >> j) & 1) if encoding == 'log' else float(j == n)
+                s[j].value = y[j].value*v.value
 
     def _collect_bilinear(self, expr, bilin, quad):
         if not expr.is_expression():
@@ -0,0 +1,82 @@
+import os
+import sys
+import types
+import cPickle as pickle
+from uuid import uuid4
+
+
+def _localFunctionId(obj):
+    # Construction rules are closures, which cannot be pickled. They are
+    # not needed once the model is built, so they are stored as None.
+    if isinstance(obj, types.FunctionType):
+        module = sys.modules.get(obj.__module__)
+        if getattr(module, obj.__name__, None) is not obj:
+            return 'localFunction'
+    return None
+
+def _loadPersistent(pid):
+    return None
+
+
+class ModelCache:
+    """
+    Content-addressed on-disk store of pickled Pyomo models with
+    least-recently-used eviction once the files exceed maxBytes.
+    """
+
+    def __init__(self, directory, maxBytes=2*1024**3):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, '%s.pkl' % key)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.pkl'):
+                filename = os.path.join(self.directory, name)
+                stat = os.stat(filename)
+                entries.append((stat.st_mtime, stat.st_size, filename))
+        return sorted(entries)
+
+    def get(self, key):
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                unpickler = pickle.Unpickler(f)
+                unpickler.persistent_load = _loadPersistent
+                model = unpickler.load()
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+        os.utime(filename, None)
+        return model
+
+    def put(self, key, model):
+        filename = self._filename(key)
+        tmpFilename = '%s.%s.tmp' % (filename, uuid4().hex)
+        with open(tmpFilename, 'wb') as f:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            pickler.persistent_id = _localFunctionId
+            pickler.dump(model)
+        os.rename(tmpFilename, filename)
+        self.evict(keep=filename)
+
+    def evict(self, keep=None):
+        entries = self._entries()
+        totalBytes = sum(size for _, size, _ in entries)
+        for _, size, filename in entries:
+            if totalBytes <= self.maxBytes:
+                break
+            if filename != keep:
+                os.remove(filename)
+                totalBytes -= size
+
+    def getOrConstruct(self, key, construct):
+        model = self.get(key)
+        if model is None:
+            model = construct()
+            self.put(key, model)
+        return model
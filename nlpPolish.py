@@ -0,0 +1,87 @@
+from __future__ import division
+import time
+import numpy as np
+from multiprocessing import Pool, cpu_count
+
+from hopperUtil import *
+
+# Set before the pool forks, the models cannot be pickled
+_polishProblem = None
+
+# ipopt's default constr_viol_tol
+defaultConstraintViolationTol = 1e-4
+
+
+def fixContactSchedule(m):
+    # Fixes the binaries of m (contact regions and the rest) to their
+    # rounded values.
+    for var in m.component_data_objects(Var):
+        if not var.is_continuous() and not var.fixed and var.value is not None:
+            var.fix(round(var.value))
+
+def perturbStart(m, scale, rng):
+    # Moves the unfixed continuous variables by scale times their domain
+    # width (normally distributed), staying within the bounds.
+    for var in m.component_data_objects(Var):
+        if var.is_continuous() and not var.fixed and var.value is not None \
+                and var.lb is not None and var.ub is not None:
+            var.value = min(var.ub, max(var.lb, var.value + scale*(var.ub - var.lb)*rng.randn()))
+
+def _polishWorker(start):
+    hop, m_exact, solutions, scale, seed, solverOptions = _polishProblem
+    source, index = start
+    result = {'source': source, 'start': index, 'objective': None, 'solution': None}
+    try:
+        t0 = time.time()
+        m = m_exact.clone()
+        hop.seedSolution(m, solutions[source])
+        fixContactSchedule(m)
+        if index > 0:
+            perturbStart(m, scale, np.random.RandomState(seed + 1000*source + index))
+        opt = SolverFactory('ipopt')
+        for key, option in solverOptions.iteritems():
+            opt.options[key] = option
+        results = solveModel(m, opt)
+        result['solveTime'] = time.time() - t0
+        result['termination'] = str(results.solver.termination_condition)
+        if len(results.solution) > 0:
+            result['objective'] = value(m.Obj)
+            result['residual'] = maxConstraintViolation(m)
+            result['torqueResidual'] = torqueBalanceResidual(m)
+            result['solution'] = hop.extractSolution(m)
+    except Exception as e:
+        result['termination'] = 'error'
+        result['message'] = ('%s: %s' % (type(e).__name__, e)).splitlines()[0]
+    return result
+
+def polishSolutions(hop, m_exact, solutions, nStarts=4, scale=0.02, tol=None, workers=None, seed=0,
+                    solverOptions={}):
+    """
+    Runs ipopt on the exact model m_exact (see addTrigConstraints; with its
+    objective and boundary conditions) with the contact schedule of each of
+    the given relaxed solutions fixed. Every solution is tried from its own
+    values and from nStarts - 1 perturbed copies, in a process pool. Returns
+    the best result whose constraint violation is below tol, or None, and
+    all results. tol is ipopt's constr_viol_tol: a given tol is passed on
+    to ipopt, and without one the constr_viol_tol of solverOptions (or
+    ipopt's default) is used.
+    """
+    global _polishProblem
+    solverOptions = dict(solverOptions)
+    solverOptions.setdefault('constr_viol_tol', defaultConstraintViolationTol if tol is None else tol)
+    if tol is None:
+        tol = solverOptions['constr_viol_tol']
+    elif tol != solverOptions['constr_viol_tol']:
+        raise ValueError('tol and the constr_viol_tol solver option differ')
+    _polishProblem = (hop, m_exact, solutions, scale, seed, solverOptions)
+    starts = [(source, index) for source in range(len(solutions)) for index in range(nStarts)]
+    pool = Pool(workers or min(len(starts), cpu_count()))
+    try:
+        results = pool.map(_polishWorker, starts)
+    finally:
+        pool.terminate()
+        _polishProblem = None
+    feasible = [result for result in results
+                if result['objective'] is not None and result['residual'] <= tol]
+    best = min(feasible, key=lambda result: result['objective']) if feasible else None
+    return best, results
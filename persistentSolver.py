@@ -0,0 +1,233 @@
+from pyomo.environ import *
+from pyomo.core.base import ComponentMap
+from pyomo.core.base.numvalue import is_constant
+from pyomo.repn import generate_canonical_repn
+from pyomo.repn.canonical_repn import LinearCanonicalRepn
+from pyomo.util.plugin import alias
+from pyomo.solvers.plugins.solvers.gurobi_direct import gurobi_direct
+from pyutilib.misc import Bunch
+try:
+    from gurobipy import GRB, LinExpr
+except ImportError:
+    GRB = None
+
+
+def _linearExpression(repn, variable):
+    # Gurobi LinExpr of a linear canonical representation, with variable
+    # mapping a Pyomo variable to its Gurobi variable.
+    if not isinstance(repn, LinearCanonicalRepn):
+        raise ValueError('Only linear constraints can be changed in a loaded model')
+    expr = LinExpr(repn.constant or 0.)
+    if repn.linear is not None:
+        expr += LinExpr(list(repn.linear), [variable(var) for var in repn.variables])
+    return expr
+
+
+def _constant(repn):
+    # Constant term of a canonical representation, which gurobi_direct
+    # moves into the right-hand side
+    if isinstance(repn, LinearCanonicalRepn):
+        return repn.constant or 0.
+    return repn[0][None] if 0 in repn else 0.
+
+
+class _GurobiPersistent(gurobi_direct):
+    """
+    gurobi_direct that builds the Gurobi model of a Pyomo model only on the
+    first solve. Later solves push the current variable bounds (and fixed
+    values) and the right-hand sides of constraints with mutable bounds, and
+    reuse everything else.
+
+    When incumbentCallback is set (see incumbentStream.solveStreaming) it is
+    called from a Gurobi callback for every new incumbent, after the values
+    of the variables in incumbentCallback.variables have been set from it,
+    with the objective, the best bound and the elapsed time. Returning True
+    stops the solve.
+    """
+
+    alias('hopper.gurobi_persistent',
+          doc='Gurobi direct interface that keeps the Gurobi model between solves')
+
+    def __init__(self, **kwds):
+        gurobi_direct.__init__(self, **kwds)
+        self._loadedModel = None
+        self._addedConstraints = {}
+        self.incumbentCallback = None
+
+    def _populate_gurobi_instance(self, pyomo_instance):
+        if pyomo_instance is not self._loadedModel:
+            gurobi_direct._populate_gurobi_instance(self, pyomo_instance)
+            self._loadedModel = pyomo_instance
+            # _presolve deletes the variable symbol map after removing the
+            # unreferenced variables from it, so keep our own reference.
+            self._loadedVariableSymbolMap = self._variable_symbol_map
+            self._mutableConstraints = []
+            for c in pyomo_instance.component_data_objects(Constraint, active=True):
+                # Range constraints are left out, Gurobi adds a variable for
+                # each of them
+                if c.equality or (c.lower is None) != (c.upper is None):
+                    bound = c.upper if c.upper is not None else c.lower
+                    if not is_constant(bound):
+                        constant = _constant(c.parent_block()._canonical_repn[c])
+                        self._mutableConstraints.append((c, self._gurobiConstraint(c), constant))
+            return
+        self._variable_symbol_map = self._loadedVariableSymbolMap
+        pyomo_instance.solutions.add_symbol_map(self._symbol_map)
+        grbmodel = self._gurobi_instance
+        grbVariables = []
+        lbs = []
+        ubs = []
+        for symbol, varRef in self._variable_symbol_map.bySymbol.iteritems():
+            var = varRef()
+            grbVariables.append(self._pyomo_gurobi_variable_map[symbol])
+            if var.fixed:
+                lbs.append(var.value)
+                ubs.append(var.value)
+            else:
+                lbs.append(-GRB.INFINITY if var.lb is None else value(var.lb))
+                ubs.append(GRB.INFINITY if var.ub is None else value(var.ub))
+        grbmodel.setAttr('LB', grbVariables, lbs)
+        grbmodel.setAttr('UB', grbVariables, ubs)
+        for c, grbConstraint, constant in self._mutableConstraints:
+            grbConstraint.RHS = value(c.upper if c.upper is not None else c.lower) - constant
+        grbmodel.update()
+
+    def _apply_solver(self):
+        if self.incumbentCallback is None:
+            return gurobi_direct._apply_solver(self)
+        # gurobi_direct._apply_solver for MIPs, with a callback
+        prob = self._gurobi_instance
+        prob.setParam('OutputFlag', 1 if self._tee else 0)
+        prob.setParam('LogFile', self._log_file)
+        for key in self.options:
+            prob.setParam(key, self.options[key])
+        prob.optimize(self._incumbentCallbackFunction())
+        prob.setParam('LogFile', 'default')
+        return Bunch(rc=None, log=None)
+
+    def _incumbentCallbackFunction(self):
+        incumbentCallback = self.incumbentCallback
+        pyomoVariables = []
+        grbVariables = []
+        for var in incumbentCallback.variables:
+            symbol = self._symbol_map.byObject.get(id(var))
+            if symbol in self._pyomo_gurobi_variable_map:
+                pyomoVariables.append(var)
+                grbVariables.append(self._pyomo_gurobi_variable_map[symbol])
+
+        def callback(model, where):
+            if where != GRB.Callback.MIPSOL:
+                return
+            for var, val in zip(pyomoVariables, model.cbGetSolution(grbVariables)):
+                var.value = val
+            if incumbentCallback(model.cbGet(GRB.Callback.MIPSOL_OBJ), model.cbGet(GRB.Callback.MIPSOL_OBJBND),
+                                 model.cbGet(GRB.Callback.RUNTIME)):
+                model.terminate()
+        return callback
+
+    def _gurobiVariable(self, var):
+        return self._pyomo_gurobi_variable_map[self._symbol_map.byObject[id(var)]]
+
+    def _gurobiConstraint(self, c):
+        return self._gurobi_instance.getConstrByName(self._symbol_map.byObject[id(c)])
+
+    def addConstraint(self, c, repn):
+        grbmodel = self._gurobi_instance
+        expr = _linearExpression(repn, self._gurobiVariable)
+        added = []
+        if c.equality:
+            added.append(grbmodel.addConstr(expr, GRB.EQUAL, value(c.lower)))
+        else:
+            if c.lower is not None:
+                added.append(grbmodel.addConstr(expr, GRB.GREATER_EQUAL, value(c.lower)))
+            if c.upper is not None:
+                added.append(grbmodel.addConstr(expr, GRB.LESS_EQUAL, value(c.upper)))
+        self._addedConstraints[id(c)] = added
+
+    def removeConstraint(self, c):
+        if id(c) in self._addedConstraints:
+            constraints = self._addedConstraints.pop(id(c))
+        else:
+            constraints = [self._gurobiConstraint(c)]
+            self._mutableConstraints = [mutable for mutable in self._mutableConstraints if mutable[0] is not c]
+        for grbConstraint in constraints:
+            self._gurobi_instance.remove(grbConstraint)
+
+
+class PersistentSolver:
+    """
+    Solves one transformed model repeatedly without redoing the work that
+    does not change between solves. The canonical representation of every
+    constraint is generated once, so the solver writers only evaluate bounds.
+    With the 'hopper.gurobi_persistent' solver the Gurobi model is also kept,
+    and only bounds, fixed values and right-hand sides are pushed before
+    each solve. Any other solver (cbc, glpk, ...) is given a freshly written
+    problem file each time; cbc and glpk only take linear objectives, e.g.
+    addHopperObjective(m, hop, norm=normL1).
+
+    Change the model only through fix, unfix, setBounds, addConstraint,
+    removeConstraint and updateConstraint, or through mutable Params that
+    appear in constraint bounds. Variables that are fixed when the solver is
+    created are folded into the constraints and cannot be unfixed later.
+    """
+
+    def __init__(self, m, opt):
+        self.m = m
+        self.opt = opt
+        self.persistent = isinstance(opt, _GurobiPersistent)
+        self.m.persistentConstraints = ConstraintList()
+        self._foldedVariables = set(id(var) for var in m.component_data_objects(Var) if var.fixed)
+        for block in m.block_data_objects(active=True):
+            block._canonical_repn = ComponentMap()
+            for c in block.component_data_objects(Constraint, active=True, descend_into=False):
+                block._canonical_repn[c] = generate_canonical_repn(c.body)
+            for objective in block.component_data_objects(Objective, active=True, descend_into=False):
+                block._canonical_repn[objective] = generate_canonical_repn(objective.expr)
+            block._gen_con_canonical_repn = False
+            block._gen_obj_canonical_repn = False
+
+    def _loaded(self):
+        return self.persistent and self.opt._loadedModel is self.m
+
+    def fix(self, var, value=None):
+        if value is not None:
+            var.value = value
+        var.fix()
+
+    def unfix(self, var):
+        if id(var) in self._foldedVariables:
+            raise ValueError('%s was fixed when the model was loaded and cannot be unfixed' % var.cname(True))
+        var.unfix()
+
+    def setBounds(self, var, lb, ub):
+        var.setlb(lb)
+        var.setub(ub)
+
+    def addConstraint(self, expr):
+        c = self.m.persistentConstraints.add(expr)
+        repn = generate_canonical_repn(c.body)
+        c.parent_block()._canonical_repn[c] = repn
+        if self._loaded():
+            self.opt.addConstraint(c, repn)
+        return c
+
+    def removeConstraint(self, c):
+        if self._loaded():
+            self.opt.removeConstraint(c)
+        c.deactivate()
+
+    def updateConstraint(self, c):
+        # Regenerate c after a change of its body, e.g. a mutable Param in a
+        # coefficient.
+        repn = generate_canonical_repn(c.body)
+        c.parent_block()._canonical_repn[c] = repn
+        if self._loaded():
+            self.opt.removeConstraint(c)
+            self.opt.addConstraint(c, repn)
+
+    def solve(self, **solveOptions):
+        # Loads the solution (if any) into the model, as hopperUtil.solveModel
+        results = self.opt.solve(self.m, output_fixed_variable_bounds=True, load_solutions=False, **solveOptions)
+        if len(results.solution) > 0:
+            self.m.solutions.load_from(results)
+        return results
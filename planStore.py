@@ -0,0 +1,61 @@
+import json
+import os
+import numpy as np
+from uuid import uuid4
+
+
+class PlanStore:
+    """
+    Directory of solved plans. Each plan is an extractSolution() array saved
+    as <key>.npy, which np.load memory-maps instead of reading, next to a
+    <key>.json sidecar with the terrain regions and solver metadata.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _filename(self, key, extension):
+        return os.path.join(self.directory, '%s.%s' % (key, extension))
+
+    def _write(self, filename, write):
+        tmpFilename = '%s.%s.tmp' % (filename, uuid4().hex)
+        with open(tmpFilename, 'wb') as f:
+            write(f)
+        os.rename(tmpFilename, filename)
+
+    def put(self, key, solution, hop=None, metadata=None):
+        sidecar = {'metadata': metadata or {}}
+        if hop is not None:
+            sidecar.update(N=hop.N, feet=hop.footnames, regions=hop.terrainDescription(),
+                           platforms=hop.platforms, momentOfInertia=hop.momentOfInertia)
+        # The plan is written last, so keys() only lists complete entries
+        self._write(self._filename(key, 'json'), lambda f: json.dump(sidecar, f, sort_keys=True))
+        self._write(self._filename(key, 'npy'), lambda f: np.save(f, solution))
+
+    def keys(self):
+        return sorted(name[:-len('.npy')] for name in os.listdir(self.directory) if name.endswith('.npy'))
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key, 'npy'))
+
+    def get(self, key, mmap=True):
+        return np.load(self._filename(key, 'npy'), mmap_mode='r' if mmap else None)
+
+    def sidecar(self, key):
+        with open(self._filename(key, 'json')) as f:
+            return json.load(f)
+
+    def metadata(self, key):
+        return self.sidecar(key)['metadata']
+
+    def regions(self, key):
+        # Terrain regions in the layout of Hopper.regions
+        return [dict((name, None if entry is None else np.array(entry)) for name, entry in region.iteritems())
+                for region in self.sidecar(key).get('regions', [])]
+
+    def plans(self, keys=None):
+        # (key, memory-mapped plan) for the given or all stored plans
+        for key in (self.keys() if keys is None else keys):
+            yield key, self.get(key)
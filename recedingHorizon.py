@@ -0,0 +1,93 @@
+from __future__ import division
+import time
+import numpy as np
+
+from hopperUtil import *
+from persistentSolver import PersistentSolver
+
+
+class RecedingHorizonPlanner:
+    """
+    Keeps one transformed and relaxed model of a Hopper and re-solves it
+    from new start states. The initial state, the goal and the set of
+    usable regions are the only things changed between solves; the
+    previous plan, shifted by one step, is used as the MIP start. replan
+    returns None when the solver finds no solution, and the next replan
+    then starts cold instead of from a stale plan. Pass
+    constructGurobiSolver(persistent=True) as opt to also keep the Gurobi
+    model between solves.
+    """
+
+    def __init__(self, hop, opt, assembly='arrays'):
+        self.hop = hop
+        self.opt = opt
+        m_nlp = hop.constructPyomoModel(assembly=assembly, prune=False)
+        self.m = constructRelaxedModel(m_nlp)
+        addHopperObjective(self.m, hop)
+        addMutableBoundaryConditions(self.m)
+        self.fixedIndicators = set(id(indicator)
+                                   for indicators in (self.m.footRegionIndicators, self.m.bodyRegionIndicators)
+                                   for indicator in indicators.itervalues() if indicator.fixed)
+        self.solver = PersistentSolver(self.m, opt)
+        self.solution = None
+        self.results = None
+        self.timings = {}
+
+    def setState(self, state):
+        # state holds r and v as (x, z) pairs and th and w, in leg lengths
+        # and dimensionless time.
+        m = self.m
+        for i, xz in enumerate(m.R2_INDEX):
+            m.initialPosition[xz] = state['r'][i]
+            m.initialVelocity[xz] = state['v'][i]
+        m.initialOrientation = state.get('th', 0.)
+        m.initialAngularVelocity = state.get('w', 0.)
+
+    def setGoal(self, finalPositionMin):
+        self.m.finalPositionMin = finalPositionMin
+
+    def setTerrainWindow(self, regions=None):
+        # Only the given regions (all when None) may be used; the indicator
+        # variables of the others are fixed to zero.
+        m = self.m
+        for indicators in (m.footRegionIndicators, m.bodyRegionIndicators):
+            for index, indicator in indicators.iteritems():
+                if id(indicator) in self.fixedIndicators:
+                    continue
+                if regions is None or index[0] in regions:
+                    self.solver.unfix(indicator)
+                else:
+                    self.solver.fix(indicator, 0)
+
+    def shiftedSolution(self, steps=1):
+        # The previous plan advanced by the given number of steps, with the
+        # final record repeated to fill the horizon.
+        shifted = np.concatenate((self.solution[steps:], self.solution[-1:].repeat(steps)))
+        shifted['t'][-steps:] = shifted['t'][-steps-1] + \
+            np.cumsum(np.diff(self.solution['t'])[-steps:])
+        shifted['t'] -= shifted['t'][0]
+        return shifted
+
+    def replan(self, state, finalPositionMin=None, regions=None, steps=1, **solveOptions):
+        # steps is the number of steps since the previous (successful)
+        # replan, by which its plan is shifted for the MIP start.
+        t0 = time.time()
+        self.setState(state)
+        if finalPositionMin is not None:
+            self.setGoal(finalPositionMin)
+        self.setTerrainWindow(regions)
+        if self.solution is not None:
+            self.hop.seedSolution(self.m, self.shiftedSolution(steps))
+        self.timings['update'] = time.time() - t0
+
+        t0 = time.time()
+        self.results = self.solver.solve(warmstart=self.solution is not None, **solveOptions)
+        self.timings['solve'] = time.time() - t0
+
+        t0 = time.time()
+        if len(self.results.solution) > 0:
+            self.solution = self.hop.extractSolution(self.m)
+        else:
+            self.solution = None
+        self.timings['extract'] = time.time() - t0
+        return self.solution
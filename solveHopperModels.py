@@ -1,8 +1,13 @@
-results = opt.solve(m, tee=True)
+hop.seedContactHeuristic(m)
+# Every incumbent is logged and shown while gurobi keeps improving it
+stream = IncumbentStream(hop, m, IncumbentLog(time.strftime('incumbents-%Y%m%d-%H%M%S.bin')),
+                         [lambda record: hop.loadSolution(record['solution'])])
+results = solveStreaming(m, opt, stream, tee=True, warmstart=True)
 m.solutions.store_to(results)
 hop.loadResults(m)
 
-m_nlp.solutions.load_from(results, ignore_invalid_labels=True)
-fixIntegerVariables(m_nlp)
-#results_nlp = opt_nlp.solve(m_nlp, tee=True)
-#hop.loadResults(m_nlp)
+polished, polishResults = polishSolutions(hop, m_nlp, [hop.extractSolution(m)], nStarts=8)
+if polished is not None:
+    print 'Polished plan: objective %f, residual %g' % (polished['objective'], polished['residual'])
+    hop.seedSolution(m_nlp, polished['solution'])
+    hop.loadResults(m_nlp)
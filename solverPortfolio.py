@@ -0,0 +1,204 @@
+from __future__ import division
+import json
+import os
+import signal
+import time
+from multiprocessing import Array, Process, Queue, cpu_count
+from Queue import Empty
+
+from hopperUtil import *
+from incumbentStream import IncumbentStream, solveStreaming
+
+# relaxation is 'mccormick' or 'mdt' for the MIP solvers and None to give
+# the bilinear model to an MINLP solver as it is.
+defaultPortfolio = [{'name': 'gurobi-mccormick', 'solver': 'gurobi', 'relaxation': 'mccormick'},
+                    {'name': 'gurobi-mdt', 'solver': 'gurobi', 'relaxation': 'mdt', 'accuracy': 0.1},
+                    {'name': 'couenne', 'solver': 'couenne', 'relaxation': None}]
+
+solverConstructors = {'gurobi': lambda threads, options: constructGurobiSolver(Threads=threads, **options),
+                      'couenne': lambda threads, options: constructCouenneSolver(),
+                      'minotaur': lambda threads, options: constructMinotaurSolver()}
+
+
+def _gap(objective, bound):
+    if objective is None or bound is None or objective == float('inf') or bound == -float('inf'):
+        return None
+    return abs(objective - bound)/max(abs(objective), 1e-10)
+
+def checkIncumbent(m, m_exact, feasibilityTol=1e-4):
+    # Objective of the solution of m (a relaxed model of m_exact, or m_exact
+    # itself) on m_exact, or None if it violates a constraint of m_exact by
+    # more than feasibilityTol.
+    if m is not m_exact:
+        copyValues(m, m_exact)
+    try:
+        if maxConstraintViolation(m_exact) > feasibilityTol:
+            return None
+        return value(m_exact.Obj)
+    except ValueError:
+        # A variable without a value
+        return None
+
+
+class _SharedIncumbent:
+    """
+    Subscriber of an IncumbentStream that publishes the incumbents that are
+    feasible for the exact model, and the bound of the solve, to the best
+    objective and bound shared by all workers of a race (a multiprocessing
+    Array). It stops the solve once the shared gap reaches targetGap or the
+    solve's own bound shows it cannot improve on the shared incumbent.
+    """
+
+    def __init__(self, m, m_exact, shared, targetGap, feasibilityTol):
+        self.m = m
+        self.m_exact = m_exact
+        self.shared = shared
+        self.targetGap = targetGap
+        self.feasibilityTol = feasibilityTol
+
+    def __call__(self, record):
+        objective = checkIncumbent(self.m, self.m_exact, self.feasibilityTol)
+        with self.shared.get_lock():
+            if objective is not None:
+                self.shared[0] = min(self.shared[0], objective)
+            self.shared[1] = max(self.shared[1], record['bound'])
+            best, bound = self.shared[0], self.shared[1]
+        gap = _gap(best, bound)
+        return (gap is not None and gap <= self.targetGap) or record['bound'] >= best
+
+
+def solveConfiguration(hop, m_nlp, configuration, boundaryConditions, threads=1, shared=None, targetGap=1e-4,
+                       feasibilityTol=1e-4):
+    # Relaxes (or not) and solves one configuration; boundaryConditions are
+    # the (r0, rf, legLength) arguments of addBoundaryConditions. Only
+    # solutions that satisfy the exact model m_nlp (within feasibilityTol)
+    # are returned as incumbents, with their exact objective; a relaxation
+    # only contributes its bound. With shared (see raceSolvers), gurobi
+    # publishes its incumbents and bound while it runs and stops early, see
+    # _SharedIncumbent.
+    result = {'name': configuration['name'], 'objective': None, 'bound': None, 'solution': None}
+    try:
+        t0 = time.time()
+        m_exact = m_nlp.clone()
+        addHopperObjective(m_exact, hop)
+        addBoundaryConditions(m_exact, *boundaryConditions)
+        if configuration['relaxation'] == 'mccormick':
+            m = constructRelaxedModel(m_nlp)
+        elif configuration['relaxation'] == 'mdt':
+            m = constructMDTModel(m_nlp, configuration['accuracy'])
+        else:
+            m = m_exact
+        if m is not m_exact:
+            addHopperObjective(m, hop)
+            addBoundaryConditions(m, *boundaryConditions)
+        options = configuration.get('options', {})
+        if configuration['solver'] == 'gurobi' and shared is not None:
+            opt = constructGurobiSolver(persistent=True, Threads=threads, **options)
+            stream = IncumbentStream(hop, m, subscribers=[_SharedIncumbent(m, m_exact, shared, targetGap,
+                                                                           feasibilityTol)])
+            # The exact model is evaluated at every incumbent
+            stream.variables = list(m.component_data_objects(Var))
+            results = solveStreaming(m, opt, stream, load_solutions=False)
+            if len(results.solution) > 0:
+                m.solutions.load_from(results)
+        else:
+            opt = solverConstructors[configuration['solver']](threads, options)
+            results = solveModel(m, opt)
+        result['solveTime'] = time.time() - t0
+        result['status'] = str(results.solver.status)
+        result['termination'] = str(results.solver.termination_condition)
+        lower = results.problem.lower_bound
+        if isinstance(lower, (int, float)):
+            result['bound'] = lower
+        if len(results.solution) > 0:
+            result['relaxedObjective'] = value(m.Obj)
+            result['objective'] = checkIncumbent(m, m_exact, feasibilityTol)
+            if result['objective'] is not None:
+                result['solution'] = hop.extractSolution(m)
+                if m is m_exact and result['termination'] == 'optimal':
+                    # An optimal solution of the exact model is also a bound
+                    result['bound'] = max(result['bound'] if result['bound'] is not None else -float('inf'),
+                                          result['objective'])
+        if shared is not None:
+            with shared.get_lock():
+                if result['objective'] is not None:
+                    shared[0] = min(shared[0], result['objective'])
+                if result['bound'] is not None:
+                    shared[1] = max(shared[1], result['bound'])
+    except Exception as e:
+        result['status'] = 'error'
+        result['termination'] = ('%s: %s' % (type(e).__name__, e)).splitlines()[0]
+    return result
+
+def _raceWorker(queue, *args):
+    # Own process group, so that stopping this worker also stops any solver
+    # executable it started.
+    os.setpgrp()
+    queue.put(solveConfiguration(*args))
+
+def raceSolvers(hop, m_nlp, boundaryConditions, portfolio=defaultPortfolio, targetGap=1e-4, timeLimit=None,
+                logFilename=None, feasibilityTol=1e-4):
+    """
+    Solves the same hopper problem with every configuration of the portfolio
+    in parallel processes and returns once the best objective and best bound
+    found so far are within targetGap. Incumbents count only when they are
+    feasible for m_nlp (within feasibilityTol); relaxations contribute their
+    bounds. The workers share the best objective and bound, so gurobi stops
+    as soon as the race is decided or it cannot improve on the incumbent of
+    another worker. The winner is the configuration of the best incumbent,
+    once the gap is reached; the other workers are then stopped. The
+    processes are forked, so m_nlp is built once and not copied.
+    """
+    threads = max(1, cpu_count()//len(portfolio))
+    queue = Queue()
+    shared = Array('d', [float('inf'), -float('inf')])
+    workers = {}
+    for configuration in portfolio:
+        worker = Process(target=_raceWorker, args=(queue, hop, m_nlp, configuration, boundaryConditions, threads,
+                                                   shared, targetGap, feasibilityTol))
+        worker.start()
+        workers[configuration['name']] = worker
+
+    t0 = time.time()
+    race = {'winner': None, 'incumbent': None, 'objective': float('inf'), 'bound': -float('inf'),
+            'solution': None, 'results': []}
+    while len(race['results']) < len(portfolio):
+        if timeLimit is not None and time.time() - t0 > timeLimit:
+            break
+        try:
+            result = queue.get(timeout=1.)
+        except Empty:
+            if not any(worker.is_alive() for worker in workers.itervalues()) and queue.empty():
+                break
+            continue
+        result['raceTime'] = time.time() - t0
+        race['results'].append(result)
+        if result['objective'] is not None and result['objective'] < race['objective']:
+            race['objective'] = result['objective']
+            race['solution'] = result['solution']
+            race['incumbent'] = result['name']
+        # Bounds published by workers that are still running count as well
+        race['bound'] = max(race['bound'], shared[1])
+        if result['bound'] is not None:
+            race['bound'] = max(race['bound'], result['bound'])
+        gap = _gap(race['objective'], race['bound'])
+        if gap is not None and gap <= targetGap:
+            race['winner'] = race['incumbent']
+            break
+
+    for worker in workers.itervalues():
+        if worker.is_alive():
+            try:
+                os.killpg(worker.pid, signal.SIGTERM)
+            except OSError:
+                pass
+        worker.join()
+    race['gap'] = _gap(race['objective'], race['bound'])
+
+    if logFilename is not None:
+        record = {'winner': race['winner'], 'gap': race['gap'],
+                  'results': [dict((key, entry) for key, entry in result.iteritems() if key != 'solution')
+                              for result in race['results']]}
+        with open(logFilename, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+    return race
@@ -0,0 +1,177 @@
+from __future__ import division
+import csv
+import hashlib
+import itertools
+import json
+import os
+import sys
+import time
+import numpy as np
+from math import sqrt
+from multiprocessing import Pool, cpu_count
+
+from hopper import Hopper
+from hopperParameters import HopperParameters, boxMomentOfInertia
+from modelCache import ModelCache
+from planStore import PlanStore
+from hopperUtil import *
+
+resultFields = ['key', 'terrain', 'stepHeight', 'N', 'dtBounds', 'solverOptions',
+                'status', 'termination', 'objective', 'bound', 'gap',
+                'buildTime', 'relaxTime', 'solveTime', 'extractTime']
+
+defaultScenario = {'terrain': 'threePlatform',
+                   'stepHeight': 0.3,
+                   'N': 25,
+                   'legLength': 0.16,
+                   'hipInBody': {'front': {'x': 0.08, 'z': -0.04}, 'back': {'x': -0.08, 'z': -0.04}},
+                   # Dimensionless, None for boxMomentOfInertia of hipInBody
+                   'momentOfInertia': None,
+                   'r0': [0, 0.08],
+                   'rf': [1.0, 0.16],
+                   'dtBounds': (0.05, 0.2),
+                   'dtNom': 0.04,
+                   'reformulation': 'hull',
+                   'seed': None,
+                   'solverOptions': {'TimeLimit': 480.}}
+
+terrains = {'threePlatform': lambda hop, scenario: addThreePlatfomWorld(hop, scenario['legLength'],
+                                                                         scenario['stepHeight']*scenario['legLength']),
+            'flat': lambda hop, scenario: addFlatWorld(hop, scenario['legLength'])}
+
+
+def scenarioGrid(**axes):
+    # Cartesian product of the given axes on top of defaultScenario, e.g.
+    # scenarioGrid(N=[15, 25], stepHeight=[0., 0.3]).
+    names = sorted(axes)
+    for values in itertools.product(*[axes[name] for name in names]):
+        scenario = dict(defaultScenario)
+        scenario.update(zip(names, values))
+        yield scenario
+
+def scenarioKey(scenario):
+    return hashlib.sha1(json.dumps(scenario, sort_keys=True)).hexdigest()[:12]
+
+def scenarioTimeScale(scenario):
+    # Seconds to the dimensionless time of the model
+    return 1/sqrt(scenario['legLength']/9.81)
+
+def constructScenarioHopper(scenario):
+    legLength = scenario['legLength']
+    momentOfInertia = scenario['momentOfInertia']
+    if momentOfInertia is None:
+        momentOfInertia = boxMomentOfInertia(legLength, scenario['hipInBody'])
+    hop = Hopper(scenario['N'], parameters=HopperParameters(legLength, scenario['hipInBody'], momentOfInertia),
+                 reformulation=scenario['reformulation'])
+    timeScale = scenarioTimeScale(scenario)
+    hop.dtBounds = tuple(timeScale*np.array(scenario['dtBounds']))
+    hop.dtNom = scenario['dtNom']*timeScale
+    hop.rotationMax = np.pi/8
+    hop.nOrientationSectors = 1
+    hop.velocityMax = 3.
+    hop.positionMax = 1.5*scenario['rf'][0]/legLength
+    hop.forceMax = 3.
+    hop.angularVelocityMax = 5.
+    hop.r0 = [scenario['r0'][0]/legLength, None]
+    hop.rfMin = [scenario['rf'][0]/legLength, None]
+    terrains[scenario['terrain']](hop, scenario)
+    return hop
+
+def solveScenario(scenario, threads=1, cacheDirectory=None, planDirectory=None):
+    row = {'key': scenarioKey(scenario), 'terrain': scenario['terrain'],
+           'stepHeight': scenario['stepHeight'], 'N': scenario['N'],
+           'dtBounds': json.dumps(scenario['dtBounds']),
+           'solverOptions': json.dumps(scenario['solverOptions'], sort_keys=True)}
+    try:
+        t0 = time.time()
+        hop = constructScenarioHopper(scenario)
+        cache = None if cacheDirectory is None else ModelCache(cacheDirectory)
+        modelKey = hop.modelKey(relaxation='mccormick')
+        m = None if cache is None else cache.get(modelKey)
+        if m is None:
+            m_nlp = hop.constructPyomoModel()
+            row['buildTime'] = time.time() - t0
+
+            t0 = time.time()
+            m = constructRelaxedModel(m_nlp)
+            if cache is not None:
+                cache.put(modelKey, m)
+            row['relaxTime'] = time.time() - t0
+        else:
+            row['buildTime'] = time.time() - t0
+            row['relaxTime'] = 0.
+        # McCormickEnvelope only relaxes constraints of degree two, so the
+        # objective and boundary conditions can be added to the relaxed model.
+        addHopperObjective(m, hop)
+        addBoundaryConditions(m, scenario['r0'], scenario['rf'], scenario['legLength'])
+
+        t0 = time.time()
+        # seed is None, 'heuristic' or a saved solution file
+        if scenario['seed'] == 'heuristic':
+            hop.seedContactHeuristic(m)
+        elif scenario['seed'] is not None:
+            hop.seedSolution(m, scenario['seed'])
+        opt = constructGurobiSolver(Threads=threads, **scenario['solverOptions'])
+        results = solveModel(m, opt, warmstart=scenario['seed'] is not None)
+        row['solveTime'] = time.time() - t0
+        row['status'] = str(results.solver.status)
+        row['termination'] = str(results.solver.termination_condition)
+        lower = results.problem.lower_bound
+        row['bound'] = lower
+        loaded = len(results.solution) > 0
+        if loaded:
+            row['objective'] = value(m.Obj)
+            if lower is not None and abs(row['objective']) > 0:
+                row['gap'] = abs(row['objective'] - lower)/abs(row['objective'])
+
+        t0 = time.time()
+        solution = hop.extractSolution(m)
+        if planDirectory is not None and loaded:
+            PlanStore(planDirectory).put(row['key'], solution, hop, metadata=dict(row, scenario=scenario))
+        row['extractTime'] = time.time() - t0
+    except Exception as e:
+        row['status'] = 'error'
+        row['termination'] = ('%s: %s' % (type(e).__name__, e)).splitlines()[0]
+    return row
+
+def _solveScenarioWorker(args):
+    return solveScenario(*args)
+
+def completedScenarios(filename):
+    if not os.path.exists(filename):
+        return set()
+    with open(filename, 'rb') as f:
+        return set(row['key'] for row in csv.DictReader(f) if row['status'] != 'error')
+
+def runSweep(scenarios, filename, workers=None, threads=None, cacheDirectory=None, planDirectory=None):
+    # Solves every scenario without a successful row in the results table,
+    # appending one row per scenario as soon as it finishes. Failed scenarios
+    # are retried on the next run.
+    if workers is None:
+        workers = max(1, cpu_count()//4)
+    if threads is None:
+        threads = max(1, cpu_count()//workers)
+    done = completedScenarios(filename)
+    pending = [scenario for scenario in scenarios if scenarioKey(scenario) not in done]
+    print 'Sweep: %d scenarios (%d already done), %d workers x %d threads' % (len(pending) + len(done), len(done), workers, threads)
+    newFile = not os.path.exists(filename)
+    with open(filename, 'ab') as f:
+        writer = csv.DictWriter(f, resultFields)
+        if newFile:
+            writer.writeheader()
+        pool = Pool(workers)
+        try:
+            for row in pool.imap_unordered(_solveScenarioWorker, [(scenario, threads, cacheDirectory, planDirectory) for scenario in pending]):
+                writer.writerow(row)
+                f.flush()
+                print '%s %s %s' % (row['key'], row['status'], row.get('objective'))
+        finally:
+            pool.terminate()
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else 'sweepResults.csv'
+    cacheDirectory = sys.argv[2] if len(sys.argv) > 2 else None
+    planDirectory = sys.argv[3] if len(sys.argv) > 3 else None
+    runSweep(scenarioGrid(N=[15, 25], stepHeight=[0., 0.15, 0.3]), filename, cacheDirectory=cacheDirectory,
+             planDirectory=planDirectory)
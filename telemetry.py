@@ -0,0 +1,165 @@
+import cProfile
+import json
+import os
+import resource
+import time
+from pyomo.environ import Constraint
+from pyomo.core.base.expr import identify_variables
+from pyomo.core.plugins.transform.radix_linearization import RadixLinearization
+
+
+def modelCounters(m):
+    # Sizes of what the solver would see: unfixed continuous and binary
+    # variables in active constraints, active constraints, nonzeros and
+    # remaining bilinear terms.
+    continuous = set()
+    binary = set()
+    counters = {'constraints': 0, 'nonzeros': 0, 'bilinearTerms': 0}
+    bilinear = []
+    radix = RadixLinearization()
+    for c in m.component_data_objects(Constraint, active=True):
+        counters['constraints'] += 1
+        for var in identify_variables(c.body, include_fixed=False):
+            counters['nonzeros'] += 1
+            (binary if var.is_binary() else continuous).add(id(var))
+        if c.body.polynomial_degree() == 2:
+            radix._collect_bilinear(c.body, bilinear, [])
+    counters['bilinearTerms'] = len(bilinear)
+    counters['continuousVariables'] = len(continuous)
+    counters['binaryVariables'] = len(binary)
+    return counters
+
+
+class _Stage:
+    def __init__(self, telemetry, name):
+        self.telemetry = telemetry
+        self.name = name
+
+    def __enter__(self):
+        self.telemetry._stack.append(self.name)
+        # Extra fields for this stage's record
+        self.extra = {}
+        self.profiler = None
+        if self.telemetry.profileDirectory is not None:
+            # Only one profiler can be active, so the enclosing stage's
+            # profiler is paused while this one runs.
+            profilers = self.telemetry._profilers
+            if profilers:
+                profilers[-1].disable()
+            self.profiler = cProfile.Profile()
+            profilers.append(self.profiler)
+            self.profiler.enable()
+        self.t0 = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = time.time() - self.t0
+        record = {'stage': '/'.join(self.telemetry._stack), 'time': elapsed}
+        record.update(self.extra)
+        if self.profiler is not None:
+            self.profiler.disable()
+            profilers = self.telemetry._profilers
+            profilers.pop()
+            if profilers:
+                profilers[-1].enable()
+            record['profile'] = os.path.join(self.telemetry.profileDirectory, '%d-%s.prof' %
+                                             (len(self.telemetry.records), record['stage'].replace('/', '.')))
+            self.profiler.dump_stats(record['profile'])
+        # Peak RSS of the process so far, in kilobytes on Linux
+        record['peakRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.telemetry._stack.pop()
+        self.telemetry._record(record)
+        return False
+
+
+class Telemetry:
+    """
+    Wall-clock timers and model-size counters for the stages of the planning
+    pipeline. Stages nest, and each finished stage or counted model becomes a
+    record in self.records, which is also appended to logFilename as one JSON
+    line when given. With a profileDirectory, every stage is run under
+    cProfile and its stats are dumped there; the profile of a stage leaves
+    out the stages nested in it.
+    """
+
+    enabled = True
+
+    def __init__(self, logFilename=None, profileDirectory=None):
+        self.logFilename = logFilename
+        self.profileDirectory = profileDirectory
+        self.records = []
+        self._stack = []
+        self._profilers = []
+        if profileDirectory is not None and not os.path.isdir(profileDirectory):
+            os.makedirs(profileDirectory)
+
+    def _record(self, record):
+        self.records.append(record)
+        if self.logFilename is not None:
+            with open(self.logFilename, 'a') as f:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def count(self, name, m):
+        record = {'stage': '/'.join(self._stack + [name])}
+        record.update(modelCounters(m))
+        self._record(record)
+
+    def report(self):
+        # Total time and latest counters per stage, in order of first use
+        stages = []
+        totals = {}
+        for record in self.records:
+            if record['stage'] not in totals:
+                stages.append(record['stage'])
+                totals[record['stage']] = {'calls': 0, 'time': 0.}
+            total = totals[record['stage']]
+            if 'time' in record:
+                total['calls'] += 1
+                total['time'] += record['time']
+                total['peakRSS'] = record['peakRSS']
+            else:
+                total.update((key, value) for key, value in record.iteritems() if key != 'stage')
+        return [dict(totals[stage], stage=stage) for stage in stages]
+
+    def summary(self):
+        lines = ['%-40s %6s %10s %10s %10s %10s' % ('stage', 'calls', 'time [s]', 'variables', 'binaries', 'nonzeros')]
+        for row in self.report():
+            lines.append('%-40s %6d %10.3f %10s %10s %10s' % (row['stage'], row['calls'], row['time'],
+                                                             row.get('continuousVariables', '-'),
+                                                             row.get('binaryVariables', '-'),
+                                                             row.get('nonzeros', '-')))
+        return '\n'.join(lines)
+
+
+class _NullStage:
+    def __init__(self):
+        self.extra = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+class NullTelemetry:
+    # Stand-in used when telemetry is disabled; every call is a no-op.
+    enabled = False
+    records = []
+
+    def stage(self, name):
+        return _NullStage()
+
+    def count(self, name, m):
+        pass
+
+    def report(self):
+        return []
+
+    def summary(self):
+        return ''
+
+nullTelemetry = NullTelemetry()
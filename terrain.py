@@ -0,0 +1,175 @@
+from __future__ import division
+import json
+import numpy as np
+from scipy.optimize import linprog
+
+
+def _rows(value):
+    return np.atleast_2d(np.asarray(value, dtype=float))
+
+def _column(value):
+    return np.asarray(value, dtype=float).ravel()
+
+
+class Terrain:
+    """
+    Compiled form of a list of terrain regions (in the layout of
+    Hopper.regions). The polytopes of all regions are kept as one array of
+    rows A x <= b, the equality constraints of a region stacked after its
+    inequalities as pairs of opposite rows; region r owns rows
+    offsets[r]:offsets[r + 1], of which the first nIneq[r] come from its
+    inequalities. Friction coefficients, normals and friction cone basis
+    vectors are arrays over the regions, and bounding boxes are computed
+    once per set of position bounds. overlapping() looks up the regions
+    whose bounding box meets a given box in an index of the boxes sorted by
+    their lower x.
+
+    Terrains are saved to and loaded from .npz files of these arrays, and
+    also load from .json files holding a list of regions (e.g. the output
+    of Hopper.terrainDescription or a planStore.PlanStore sidecar).
+    """
+
+    def __init__(self, A, b, offsets, nIneq, mu, normals):
+        self.A = _rows(A).reshape(-1, 2)
+        self.b = _column(b)
+        self.offsets = np.asarray(offsets, dtype=int)
+        self.nIneq = np.asarray(nIneq, dtype=int)
+        self.mu = _column(mu)
+        self.normals = _rows(normals).reshape(-1, 2)
+        self.nRegions = len(self.mu)
+        self.free = self.mu == 0.
+        # basisVectors[region, bv] = rot(+-atan(mu))*normal, + for bv 0
+        theta = np.arctan(self.mu)[:, np.newaxis]
+        normalX, normalZ = self.normals[:, 0:1], self.normals[:, 1:2]
+        self.basisVectors = np.stack([np.hstack((np.cos(sign*theta)*normalX - np.sin(sign*theta)*normalZ,
+                                                 np.sin(sign*theta)*normalX + np.cos(sign*theta)*normalZ))
+                                      for sign in [1., -1.]], axis=1)
+        self._extents = {}
+        self._indices = {}
+
+    @classmethod
+    def fromRegions(cls, regions):
+        A = []
+        b = []
+        offsets = [0]
+        nIneq = []
+        for region in regions:
+            rows = 0
+            if region['A'] is not None:
+                A.append(_rows(region['A']))
+                b.append(_column(region['b']))
+                rows += len(b[-1])
+            nIneq.append(rows)
+            if region['Aeq'] is not None:
+                Aeq = _rows(region['Aeq'])
+                beq = _column(region['beq'])
+                A += [Aeq, -Aeq]
+                b += [beq, -beq]
+                rows += 2*len(beq)
+            offsets.append(offsets[-1] + rows)
+        normals = [_column(region['normal']) if region['normal'] is not None else np.zeros(2)
+                   for region in regions]
+        return cls(np.vstack(A) if A else np.zeros((0, 2)), np.concatenate(b) if b else np.zeros(0),
+                   offsets, nIneq, [region['mu'] or 0. for region in regions], normals)
+
+    @classmethod
+    def load(cls, filename):
+        if filename.endswith('.json'):
+            with open(filename) as f:
+                regions = json.load(f)
+            if isinstance(regions, dict):
+                regions = regions['regions']
+            return cls.fromRegions([dict((key, region.get(key)) for key in ['A', 'b', 'Aeq', 'beq', 'normal', 'mu'])
+                                    for region in regions])
+        data = np.load(filename)
+        return cls(data['A'], data['b'], data['offsets'], data['nIneq'], data['mu'], data['normals'])
+
+    def save(self, filename):
+        np.savez(filename, A=self.A, b=self.b, offsets=self.offsets, nIneq=self.nIneq, mu=self.mu,
+                 normals=self.normals)
+
+    def stacked(self, region):
+        # All rows of the region, equalities included (views)
+        rows = slice(self.offsets[region], self.offsets[region + 1])
+        return self.A[rows], self.b[rows]
+
+    def inequalities(self, region):
+        # Only the rows of the region's own inequalities (views)
+        rows = slice(self.offsets[region], self.offsets[region] + self.nIneq[region])
+        return self.A[rows], self.b[rows]
+
+    def regions(self):
+        # The regions in the layout of Hopper.regions (for Hopper.addRegion),
+        # with a single equality as a row and a number, as addPlatform gives
+        regions = []
+        for region in range(self.nRegions):
+            A, b = self.stacked(region)
+            nIneq = self.nIneq[region]
+            nEq = (len(b) - nIneq)//2
+            Aeq, beq = None, None
+            if nEq == 1:
+                Aeq, beq = A[nIneq].copy(), float(b[nIneq])
+            elif nEq:
+                Aeq, beq = A[nIneq:nIneq + nEq].copy(), b[nIneq:nIneq + nEq, np.newaxis].copy()
+            regions.append({'A': A[:nIneq].copy() if nIneq else None,
+                            'b': b[:nIneq, np.newaxis].copy() if nIneq else None,
+                            'Aeq': Aeq,
+                            'beq': beq,
+                            'normal': self.normals[region][:, np.newaxis].copy(),
+                            'mu': float(self.mu[region])})
+        return regions
+
+    def support(self, a, region, positionMax, shrink=0.):
+        # max a*x over the region (with its inequalities moved in by shrink)
+        # intersected with |x| <= positionMax, or None if that set is empty.
+        A, b = self.stacked(region)
+        result = linprog(-np.asarray(a, dtype=float), A_ub=A,
+                         b_ub=b - shrink*(np.arange(len(b)) < self.nIneq[region]),
+                         bounds=[(-positionMax, positionMax)]*2)
+        if result.status != 0:
+            return None
+        return -result.fun
+
+    def extent(self, region, positionMax, shrink=0.):
+        # Bounding box (lower, upper) of the region within |x| <= positionMax,
+        # or None if that set is empty.
+        key = (region, positionMax, shrink)
+        if key not in self._extents:
+            upper = [self.support(axis, region, positionMax, shrink) for axis in np.eye(2)]
+            lower = [self.support(-axis, region, positionMax, shrink) for axis in np.eye(2)]
+            if None in upper or None in lower:
+                self._extents[key] = None
+            else:
+                self._extents[key] = (-np.array(lower), np.array(upper))
+        return self._extents[key]
+
+    def boundingBoxes(self, positionMax, shrink=0.):
+        # (nRegions x 2 x 2) array of [lower, upper] corners, NaN for empty
+        # regions
+        boxes = np.nan*np.ones((self.nRegions, 2, 2))
+        for region in range(self.nRegions):
+            extent = self.extent(region, positionMax, shrink)
+            if extent is not None:
+                boxes[region] = extent
+        return boxes
+
+    def _index(self, positionMax, shrink, freeOnly):
+        key = (positionMax, shrink, freeOnly)
+        if key not in self._indices:
+            regions = np.flatnonzero(self.free) if freeOnly else np.arange(self.nRegions)
+            boxes = np.array([self.extent(region, positionMax, shrink) or np.nan*np.ones((2, 2))
+                              for region in regions]).reshape(-1, 2, 2)
+            nonEmpty = ~np.isnan(boxes[:, 0, 0])
+            regions, boxes = regions[nonEmpty], boxes[nonEmpty]
+            order = np.argsort(boxes[:, 0, 0], kind='mergesort')
+            self._indices[key] = (regions[order], boxes[order])
+        return self._indices[key]
+
+    def overlapping(self, lower, upper, positionMax, shrink=0., freeOnly=False):
+        # Regions (in ascending order) whose bounding box within
+        # |x| <= positionMax, with the region shrunk by shrink, meets the box
+        # [lower, upper]. freeOnly leaves out the contact regions.
+        regions, boxes = self._index(positionMax, shrink, freeOnly)
+        n = np.searchsorted(boxes[:, 0, 0], upper[0], side='right')
+        hits = np.all(boxes[:n, 1] >= lower, axis=1) & np.all(boxes[:n, 0] <= upper, axis=1)
+        return np.sort(regions[:n][hits])
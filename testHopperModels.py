@@ -0,0 +1,61 @@
+import unittest
+import benchmarkHopperModels
+from hopper import Hopper
+from hopperParameters import HopperParameters, boxMomentOfInertia
+from hopperUtil import *
+
+legLength = 0.16
+hipInBody = {'front': {'x': 0.5*legLength, 'z': -0.25*legLength},
+             'back': {'x': -0.5*legLength, 'z': -0.25*legLength}}
+parameters = HopperParameters(legLength, hipInBody, boxMomentOfInertia(legLength, hipInBody))
+
+def constructTestHopper(N, reformulation='hull', pruned=False):
+    hop = Hopper(N, parameters=parameters, reformulation=reformulation)
+    addThreePlatfomWorld(hop, legLength, 0.3*legLength)
+    if pruned:
+        hop.r0 = [0, None]
+        hop.rfMin = [0.3/legLength, None]
+    return hop
+
+class TestModelAssembly(unittest.TestCase):
+    def assertSameModels(self, N, reformulation, pruned):
+        models = [constructTestHopper(N, reformulation, pruned).constructPyomoModel(assembly=assembly)
+                  for assembly in ('rules', 'arrays')]
+        self.assertEqual(compareModels(*models), [])
+
+    def testHull(self):
+        self.assertSameModels(6, 'hull', False)
+
+    def testPrunedHull(self):
+        self.assertSameModels(6, 'hull', True)
+
+    def testBigM(self):
+        self.assertSameModels(6, 'bigm', True)
+
+    def testHybrid(self):
+        self.assertSameModels(6, 'hybrid', True)
+
+class TestModelSizes(unittest.TestCase):
+    def testReformulations(self):
+        sizes = dict((reformulation, benchmarkHopperModels.timeReformulation(8, reformulation)[:2])
+                     for reformulation in ('hull', 'bigm', 'hybrid'))
+        for i in range(2):
+            self.assertLess(sizes['bigm'][i], sizes['hybrid'][i])
+            self.assertLess(sizes['hybrid'][i], sizes['hull'][i])
+
+    def testOrientationEncodings(self):
+        for sectors in (4, 16):
+            binaries = dict((encoding, benchmarkHopperModels.timeOrientationEncoding(6, sectors, encoding)[2])
+                            for encoding in ('cc', 'log'))
+            self.assertLess(binaries['log'], binaries['cc'])
+
+    def testPartitions(self):
+        for encoding in ('linear', 'log'):
+            sizes = [benchmarkHopperModels.timePartitionedRelaxation(6, partitions, encoding)[:2]
+                     for partitions in (1, 2, 4)]
+            for smaller, larger in zip(sizes, sizes[1:]):
+                self.assertLess(smaller[0], larger[0])
+                self.assertLess(smaller[1], larger[1])
+
+if __name__ == '__main__':
+    unittest.main()
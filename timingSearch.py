@@ -0,0 +1,222 @@
+from __future__ import division
+import json
+import os
+import signal
+import sys
+import time
+from multiprocessing import Process, Queue, cpu_count
+from Queue import Empty
+
+from sweepHopperModels import *
+
+# Terminations that prove a job infeasible
+infeasibleTerminations = ['infeasible', 'infeasibleOrUnbounded', 'unreachable']
+
+
+def _duration(job):
+    N, dt = job
+    return (N - 1)*dt
+
+def _timingWorker(queue, search, job):
+    # Own process group, so that cancelling this job also stops any solver
+    # executable it started.
+    os.setpgrp()
+    queue.put(search.solveTiming(*job))
+
+
+class TimingSearch:
+    """
+    Searches the horizon N and time step dt (in seconds, all steps equal)
+    for the shortest plan of a scenario (see sweepHopperModels) whose
+    relaxed problem is feasible. Every (N, dt) job is solved in its own
+    forked process, at most workers at a time, shortest duration first.
+
+    A feasible job dominates all jobs of equal or longer duration, which
+    are cancelled (running ones are stopped). Jobs whose dt is outside the
+    scenario's dtBounds, which the pruned models assume, and jobs that the
+    velocity bound alone rules out are never started. With monotone=True an
+    infeasible job
+    also cancels the shorter jobs with the same N; this assumes that a plan
+    that cannot be done in some time cannot be done faster either, as
+    bisect does.
+    """
+
+    def __init__(self, scenario, relaxation='mccormick', accuracy=0.1, workers=None, threads=1,
+                 logFilename=None):
+        self.scenario = scenario
+        self.relaxation = relaxation
+        self.accuracy = accuracy
+        self.workers = workers or max(1, cpu_count()//threads)
+        self.threads = threads
+        self.logFilename = logFilename
+        self.timeScale = scenarioTimeScale(scenario)
+        self._models = {}
+
+    def _model(self, N):
+        # Hopper and unrelaxed model of horizon N, built once in this process
+        # and shared with the forked workers.
+        if N not in self._models:
+            scenario = dict(self.scenario, N=N)
+            hop = constructScenarioHopper(scenario)
+            self._models[N] = (scenario, hop, hop.constructPyomoModel())
+        return self._models[N]
+
+    def outOfBounds(self, dt):
+        dtMin, dtMax = self.scenario['dtBounds']
+        return dt < dtMin or dt > dtMax
+
+    def unreachable(self, N, dt):
+        # True if the distance from r0 to rf cannot be covered at the
+        # velocity bound in (N - 1) steps of dt.
+        scenario, hop, m_nlp = self._model(N)
+        distance = abs(scenario['rf'][0] - scenario['r0'][0])/scenario['legLength']
+        return distance > hop.velocityMax*(N - 1)*dt*self.timeScale
+
+    def solveTiming(self, N, dt):
+        result = {'N': N, 'dt': dt, 'duration': _duration((N, dt)), 'objective': None, 'solution': None}
+        try:
+            t0 = time.time()
+            scenario, hop, m_nlp = self._model(N)
+            if self.relaxation == 'mdt':
+                m = constructMDTModel(m_nlp, self.accuracy, dt=dt*self.timeScale)
+            else:
+                m = constructRelaxedModel(m_nlp, dt=dt*self.timeScale)
+            addHopperObjective(m, hop)
+            addBoundaryConditions(m, scenario['r0'], scenario['rf'], scenario['legLength'])
+            opt = constructGurobiSolver(Threads=self.threads, **scenario['solverOptions'])
+            results = solveModel(m, opt)
+            result['solveTime'] = time.time() - t0
+            result['status'] = str(results.solver.status)
+            result['termination'] = str(results.solver.termination_condition)
+            if len(results.solution) > 0:
+                result['objective'] = value(m.Obj)
+                result['solution'] = hop.extractSolution(m)
+        except Exception as e:
+            result['status'] = 'error'
+            result['termination'] = ('%s: %s' % (type(e).__name__, e)).splitlines()[0]
+        return result
+
+    def _cancelled(self, job, termination):
+        N, dt = job
+        return {'N': N, 'dt': dt, 'duration': _duration(job), 'objective': None, 'solution': None,
+                'status': 'aborted', 'termination': termination}
+
+    def _dominated(self, job, results, monotone):
+        feasible = [result['duration'] for result in results if result['objective'] is not None]
+        if feasible and _duration(job) >= min(feasible):
+            return True
+        if monotone:
+            infeasible = [result['duration'] for result in results
+                          if result['N'] == job[0] and result['termination'] in infeasibleTerminations]
+            if infeasible and _duration(job) <= max(infeasible):
+                return True
+        return False
+
+    def run(self, jobs, monotone=False):
+        # Solves the (N, dt) jobs and returns the result of every job, with
+        # termination 'cancelled' for the dominated ones.
+        for N in set(N for N, dt in jobs):
+            self._model(N)
+        pending = sorted(set(jobs), key=_duration)
+        running = {}
+        queue = Queue()
+        results = []
+        while pending or running:
+            for job in [job for job in pending if self._dominated(job, results, monotone)]:
+                pending.remove(job)
+                results.append(self._cancelled(job, 'cancelled'))
+            for job, worker in running.items():
+                if self._dominated(job, results, monotone):
+                    try:
+                        os.killpg(worker.pid, signal.SIGTERM)
+                    except OSError:
+                        pass
+                    worker.join()
+                    del running[job]
+                    results.append(self._cancelled(job, 'cancelled'))
+            while pending and len(running) < self.workers:
+                job = pending.pop(0)
+                if self.outOfBounds(job[1]):
+                    results.append(self._cancelled(job, 'dtOutOfBounds'))
+                    continue
+                if self.unreachable(*job):
+                    results.append(self._cancelled(job, 'unreachable'))
+                    continue
+                worker = Process(target=_timingWorker, args=(queue, self, job))
+                worker.start()
+                running[job] = worker
+            if not running:
+                continue
+            try:
+                result = queue.get(timeout=1.)
+            except Empty:
+                for job, worker in running.items():
+                    if not worker.is_alive() and queue.empty():
+                        del running[job]
+                        results.append(dict(self._cancelled(job, 'worker died'), status='error'))
+                continue
+            job = (result['N'], result['dt'])
+            if job in running:
+                running.pop(job).join()
+                results.append(result)
+        self._log(results)
+        return results
+
+    def _log(self, results):
+        if self.logFilename is not None:
+            with open(self.logFilename, 'a') as f:
+                for result in results:
+                    f.write(json.dumps(dict((key, entry) for key, entry in result.iteritems() if key != 'solution'),
+                                       sort_keys=True) + '\n')
+
+    def _best(self, results):
+        feasible = [result for result in results if result['objective'] is not None]
+        best = min(feasible, key=lambda result: (result['duration'], result['objective'])) if feasible else None
+        return best, results
+
+    def grid(self, Ns, dts, monotone=False):
+        # Fastest feasible result over all combinations of N and dt (or
+        # None) and all results.
+        return self._best(self.run([(N, dt) for N in Ns for dt in dts], monotone))
+
+    def bisect(self, N, durationLower, durationUpper, tolerance=0.05):
+        # Fastest feasible result with horizon N and a total duration in
+        # [durationLower, durationUpper] (in seconds), to within tolerance.
+        # Each round tries one duration per worker spread over the current
+        # bracket. The bracket is first narrowed to the durations that
+        # dtBounds allows.
+        dtMin, dtMax = self.scenario['dtBounds']
+        results = []
+        lower, upper = max(durationLower, (N - 1)*dtMin), min(durationUpper, (N - 1)*dtMax)
+        if lower > upper:
+            return self._best(results)
+        durations = [upper]
+        while durations:
+            roundResults = self.run([(N, min(max(duration/(N - 1), dtMin), dtMax)) for duration in durations],
+                                    monotone=True)
+            results += roundResults
+            feasible = [result['duration'] for result in roundResults if result['objective'] is not None]
+            infeasible = [result['duration'] for result in roundResults
+                          if result['termination'] in infeasibleTerminations]
+            if not any(result['objective'] is not None for result in results):
+                # Not even durationUpper is known to be feasible
+                break
+            if feasible:
+                upper = min(feasible)
+            if infeasible:
+                lower = max([lower] + [duration for duration in infeasible if duration < upper])
+            if not feasible and not infeasible or upper - lower <= tolerance:
+                break
+            durations = [lower + (upper - lower)*k/(self.workers + 1) for k in range(1, self.workers + 1)]
+        return self._best(results)
+
+
+if __name__ == '__main__':
+    logFilename = sys.argv[1] if len(sys.argv) > 1 else None
+    search = TimingSearch(defaultScenario, logFilename=logFilename)
+    best, results = search.grid([15, 20, 25], [0.05, 0.075, 0.1])
+    for result in sorted(results, key=lambda result: result['duration']):
+        print '%3d %6.3f %6.3f %-12s %s' % (result['N'], result['dt'], result['duration'], result['termination'],
+                                           result['objective'])
+    if best is not None:
+        print 'Fastest: N = %d, dt = %.3f s, %.3f s' % (best['N'], best['dt'], best['duration'])